@@ -1,48 +1,105 @@
 # -*- coding:utf-8 -*-
 # vim: set ts=2 sw=2 sts=2 et:
 
-import ast
+import copy
+import io
 import json
-from re import fullmatch
-from ansible_inventory.lib import AnsibleInventory_Exception
+import shutil
+import time
+from array import array
+from contextlib import contextmanager
+from ansible_inventory.lib import AnsibleInventory_Exception, AnsibleInventory_ConflictException, get_selector, iterencode_json
 
 
 def inv_write(func):
   "Decorator for functions that change the inventory. This should grant inventory integrity when several concurrent ansible-inventory sessions"
   def wrapper(_self, *args, **kwargs):
-    try:
-      _self.backend.lock()
-      _self.reload()
-      r = func(_self, *args, **kwargs)
-      _self.save()
-      return r
-    except BlockingIOError:
-      raise AnsibleInventory_Exception("Backend temporally unavailable. Please try again.")
-    except AnsibleInventory_Exception:
-      raise
-    finally:
-      _self.backend.unlock()
+    return _self.run_transaction( func, _self, *args, **kwargs )
   return wrapper
 
 def inv_read(func):
   "Decorator for functions that read, so they use they have the most updated information in case of several concurrent ansible-inventory sessions"
   def wrapper(_self, *kargs, **kwargs):
     try:
-      if _self.from_cache:
-        _self.from_cache = False
+      if not _self.write_level and not ( _self.from_cache and _self.is_loaded() ):
         _self.reload()
+      _self.from_cache = False
       return func(_self, *kargs, **kwargs)
+    except AnsibleInventory_Exception:
+      raise
     except Exception as e:
       raise AnsibleInventory_Exception( e.__str__() )
   return wrapper
 
 
+class AnsibleInventory_Host:
+  'A host of the inventory. vars is None if the host is not in the hostvars, and groups has the ids of its groups'
+  __slots__ = ( 'id', 'name', 'vars', 'groups' )
+
+  def __init__(self, h_id, name, h_vars=None):
+    self.id = h_id
+    self.name = name
+    self.vars = h_vars
+    self.groups = array( 'I' )
+
+  def __copy__(self):
+    host = AnsibleInventory_Host( self.id, self.name, self.vars )
+    host.groups = self.groups
+    return host
+
+
+class AnsibleInventory_Group:
+  """A group of the inventory. hosts, children and parents have the ids of its hosts, subgroups and parent groups.
+  Groups can have many hosts, so removing one just adds it to removed (if it is not None) until half of them
+  are removed, and then hosts is compacted. Use host_ids() to get the hosts"""
+  __slots__ = ( 'id', 'name', 'vars', 'hosts', 'removed', 'children', 'parents' )
+
+  def __init__(self, g_id, name, g_vars=None):
+    self.id = g_id
+    self.name = name
+    self.vars = {} if g_vars is None else g_vars
+    self.hosts = array( 'I' )
+    self.removed = None
+    self.children = array( 'I' )
+    self.parents = array( 'I' )
+
+  def __copy__(self):
+    group = AnsibleInventory_Group( self.id, self.name, self.vars )
+    group.hosts = self.hosts
+    group.removed = self.removed
+    group.children = self.children
+    group.parents = self.parents
+    return group
+
+  def host_ids(self):
+    'Returns the ids of the hosts in the group, in order'
+    if not self.removed:
+      return self.hosts
+    removed = self.removed
+    return [ h_id for h_id in self.hosts if h_id not in removed ]
+
+
 class AnsibleInventory:
 
-  # Inventory variable
-  __I: dict
+  # Times a change is tried when the backend reports a conflicting save
+  CONFLICT_RETRIES = 10
 
-### Internal inventory format
+  # Name tables: group and host name -> id, and the groups and hosts by id (None once removed)
+  __groups: dict
+  __group_list: list
+  __hosts: dict
+  __host_list: list
+
+  # Changes made since the inventory was loaded or saved, as a list of delta operations (see __record)
+  __delta: list
+
+  # Copy on write: once a snapshot is taken (see snapshot) all the containers of the inventory are shared with it,
+  # so they are copied before changing them. These are the ids of the ones created since the last snapshot, which
+  # can be changed in place. Until the first snapshot nothing is shared.
+  __owned: set
+  __shared: bool
+
+### Ansible inventory format (as stored by the backends)
 #{
 #          "all"   : { 'hosts':[ all hosts here ], 'children':[], 'vars',{} },
 #    "databases"   : {
@@ -69,195 +126,589 @@ class AnsibleInventory:
 #         }
 #    }
 #}
+#
+### Internal inventory format
+# Every name is stored once, in a table that maps it to an integer id:
+#   __groups      group name -> group id, in the order of the ansible format. '_meta' is kept at its position
+#                 with a None id
+#   __hosts       host name -> host id. The hosts with vars are in the order of the hostvars, as a host is moved
+#                 to the end when it gets vars
+#   __group_list  group id -> AnsibleInventory_Group
+#   __host_list   host id -> AnsibleInventory_Host
+#   __meta        the other keys of '_meta', which are kept as they were loaded
+# Groups and hosts refer to each other by id, in arrays: the hosts and children of a group (in order) and the
+# reverse indexes, the groups of a host and the parents of a group. Ids are not reused until the inventory is
+# loaded again. The ansible format is only built by __serialize.
+# The containers of the inventory may be shared with snapshots, so changes must get them through the __*_w
+# methods (i.e. self.__group_w( g_id, 'hosts' ).append( h_id )), which copy them first if needed.
 
   def __init__(self, backend):
     self.backend = backend
-    self.reload()
+    self.__version = None
+    # The inventory is loaded when it is first used
+    self.__groups = None
     self.from_cache = False
+    self.write_level = 0
+
+  def is_loaded(self):
+    'Returns True if the inventory was already loaded from the backend'
+    return self.__groups is not None
 
   def next_from_cache(self):
-    'This function can be called before calling any "read" method so it does not refresh the inventory from the backend'
+    'This function can be called before calling any "read" method so it does not check the backend for changes'
     self.from_cache = True
 
+  def invalidate(self):
+    'Forces the inventory to be loaded from the backend on the next reload'
+    self.__version = None
+
+  @contextmanager
+  def transaction(self):
+    """Groups several changes in a single write: the backend is locked and the inventory is loaded once, and it is
+    saved once when the block ends. If an exception escapes the block nothing is saved. Transactions can be nested."""
+    if self.write_level:
+      self.write_level += 1
+      try:
+        yield self
+      finally:
+        self.write_level -= 1
+      return
+
+    try:
+      self.backend.lock()
+      self.reload()
+      self.write_level = 1
+      try:
+        yield self
+        self.__save_changes()
+      except BaseException:
+        # The inventory may be partially modified, so it has to be loaded again
+        self.invalidate()
+        raise
+      finally:
+        self.write_level = 0
+    except BlockingIOError:
+      raise AnsibleInventory_Exception("Backend temporally unavailable. Please try again.")
+    finally:
+      self.backend.unlock()
+
+  def run_transaction(self, func, *args, **kwargs):
+    """Runs func( *args, **kwargs ) in a transaction and returns its result. If someone else saved the inventory in
+    the meantime (see AnsibleInventory_ConflictException), func is run again over the new inventory, so it should
+    only change the inventory. Within another transaction it is just run, as the outer one is the one saved."""
+    for attempt in range( self.CONFLICT_RETRIES ):
+      try:
+        with self.transaction():
+          return func( *args, **kwargs )
+      except AnsibleInventory_ConflictException:
+        if self.write_level or attempt + 1 == self.CONFLICT_RETRIES:
+          raise
+        import random
+        time.sleep( random.uniform( 0, min( 0.01 * 2**attempt, 0.5 ) ) )
+
   def __ensure_inventory_skel(self):
-    'Ensures the basic structure of the inventory is pressent'
-    if self.__I:
-      if '_meta' not in self.__I:
-        self.__I['_meta'] = {}
-      if 'all' not in self.__I:
-        self.__I['all'] = {
-          'children': [],
-          'hosts': [],
-          'vars': {}
-        }
-      if 'hostvars' not in self.__I['_meta']:
-        self.__I['_meta']['hostvars'] = {}
+    'Ensures the basic structure of the inventory is pressent. The groups it creates are saved with the next change'
+    if '_meta' not in self.__groups:
+      self.__groups['_meta'] = None
+    if 'all' not in self.__groups:
+      self.__new_group( 'all' )
+      self.__record( 'add_group', 'all' )
 
   def save(self):
     "Saves the inventory to persistence backend"
-    self.backend.save_inventory( self.__I )
-
-  def reload(self):
-    "Loads the inventory from the persistence backend"
-    self.__I = self.backend.load_inventory()
+    inventory = self.__serialize()
+    self.__saved( self.backend.save_inventory( inventory ) )
+    if self.backend.ansible_json_path is not None:
+      self.backend.save_ansible_json( self.__version, self.__encode_ansible_json( inventory ) )
+
+  def __save_changes(self):
+    'Internal: Saves the changes made in a transaction. Backends with partial_saves only get the delta operations'
+    if not self.__delta:
+      return
+    if not self.backend.partial_saves:
+      return self.save()
+    self.__saved( self.backend.apply_delta( self.__delta ) )
+
+  def __saved(self, version):
+    'Internal: Updates the inventory state after saving it. version is the one returned by the backend, if any'
+    self.__delta = []
+    if version is None:
+      version = self.backend.get_version()
+    self.__version = version
+
+  def reload(self, force=False):
+    "Loads the inventory from the persistence backend. It is only parsed again when the backend version changed since the last load"
+    version = self.backend.get_version()
+    if not force and version is not None and version == self.__version:
+      return
+    inventory = self.backend.load_inventory()
+    self.__groups = {}
+    self.__group_list = []
+    self.__hosts = {}
+    self.__host_list = []
+    self.__meta = {}
+    # Nothing is shared with snapshots yet
+    self.__owned = set()
+    self.__shared = False
+    self.__deserialize( inventory )
+    self.__delta = []
     self.__ensure_inventory_skel()
+    self.__version = version
 
-  def __get_group_hosts(self, group):
-    'Internal: Returns a list of hosts in a group'
-    if group in self.__I:
-      if isinstance( self.__I[group], list):
-        return self.__I[group]
-      if isinstance( self.__I[group], dict ):
-        return self.__I[group]['hosts']
+  @inv_read
+  def snapshot(self):
+    """Returns a read only copy of the inventory, which takes the same time regardless of its size as all the data
+    is shared with the inventory. The inventory copies what it changes after that (copy on write), so the snapshot
+    never changes and its read methods return its data without copying it"""
+    from ansible_inventory.backends import AnsibleInventory_SnapshotBackend
+
+    # With changes that are not saved yet it does not belong to any version
+    snapshot = AnsibleInventory( AnsibleInventory_SnapshotBackend( self.backend, None if self.write_level else self.__version ) )
+    snapshot.__groups = self.__groups
+    snapshot.__group_list = self.__group_list
+    snapshot.__hosts = self.__hosts
+    snapshot.__host_list = self.__host_list
+    snapshot.__meta = self.__meta
+    snapshot.__delta = []
+    snapshot.__version = snapshot.backend.get_version()
+    snapshot.__owned = set()
+    snapshot.__shared = True
+    self.__owned = set()
+    self.__shared = True
+    return snapshot
+
+  def __deserialize(self, inventory):
+    'Internal: Loads an ansible inventory dict in the name tables, which are empty'
+    groups = self.__groups
+    group_list = self.__group_list
+    hosts = self.__hosts
+    host_list = self.__host_list
+
+    # 'hostvars' is left in its position, to be filled by __serialize
+    meta = inventory.get( '_meta' ) or {}
+    self.__meta = { k: None if k == 'hostvars' else v for k, v in meta.items() }
+
+    # The hosts with vars go first, so they keep the order of the hostvars
+    for h, h_vars in ( meta.get( 'hostvars' ) or {} ).items():
+      hosts[h] = len( host_list )
+      host_list.append( AnsibleInventory_Host( hosts[h], h, {} if h_vars is None else h_vars ) )
+
+    # The groups are created before filling them, so they keep their order
+    for g in inventory:
+      if g == '_meta':
+        groups[g] = None
+      else:
+        groups[g] = len( group_list )
+        group_list.append( AnsibleInventory_Group( groups[g], g ) )
+
+    for g, g_data in inventory.items():
+      if g == '_meta':
+        continue
+      if isinstance( g_data, list ):
+        g_data = { 'hosts': g_data }
+      group = group_list[ groups[g] ]
+      group.vars = g_data.get( 'vars' ) or {}
+      for h in g_data.get( 'hosts' ) or ():
+        h_id = hosts.get( h )
+        if h_id is None:
+          h_id = hosts[h] = len( host_list )
+          host_list.append( AnsibleInventory_Host( h_id, h ) )
+        h_groups = host_list[h_id].groups
+        # A host repeated in the list of the group is the last one added to it
+        if not h_groups or h_groups[-1] != group.id:
+          group.hosts.append( h_id )
+          h_groups.append( group.id )
+      for c in g_data.get( 'children' ) or ():
+        if c == '_meta':
+          continue
+        c_id = groups.get( c )
+        if c_id is None:
+          # As in ansible, children that are not defined are empty groups
+          c_id = groups[c] = len( group_list )
+          group_list.append( AnsibleInventory_Group( c_id, c ) )
+        if c_id not in group.children:
+          group.children.append( c_id )
+          group_list[c_id].parents.append( group.id )
+
+  def __serialize(self):
+    'Internal: Returns the inventory in the ansible inventory format'
+    host_list = self.__host_list
+    group_list = self.__group_list
+    inventory = {}
+    for g, g_id in self.__groups.items():
+      if g_id is None:
+        inventory[g] = dict( self.__meta )
+        inventory[g]['hostvars'] = { host.name: host.vars for host in map( host_list.__getitem__, self.__hosts.values() ) if host.vars is not None }
+      else:
+        group = group_list[g_id]
+        inventory[g] = {
+          'hosts': [ host_list[h_id].name for h_id in group.host_ids() ],
+          'vars': group.vars,
+          'children': [ group_list[c_id].name for c_id in group.children ]
+        }
+    return inventory
+
+  def __record(self, operation, *args):
+    '''Internal: Records a change as a delta operation for the backend. These are the operations and their arguments:
+      add_host host                   Adds a host to hostvars, with no vars
+      del_host host                   Removes a host from hostvars
+      set_host_var host name value    Sets a host var, adding the host to hostvars if needed
+      del_host_var host name          Removes a host var
+      set_host_vars host vars         Replaces all the vars of a host, adding the host to hostvars if needed
+      add_group group                 Adds an empty group
+      del_group group                 Removes a group with its hosts, children and vars (not from its parents)
+      set_group_var group name value  Sets a group var
+      del_group_var group name        Removes a group var
+      set_group_vars group vars       Replaces all the vars of a group
+      add_group_host group host       Appends a host to a group if it is not already there
+      del_group_host group host       Removes a host from a group
+      add_group_child group child     Appends a child to a group if it is not already there
+      del_group_child group child     Removes a child from a group
+      set_group_children group list   Replaces the children of a group'''
+    self.__delta.append( ( operation, ) + args )
+
+  def __own(self, container):
+    'Internal: Returns container if it can be changed in place, otherwise a copy of it that can (see __owned)'
+    if not self.__shared or id( container ) in self.__owned:
+      return container
+    container = copy.copy( container )
+    self.__owned.add( id( container ) )
+    return container
+
+  def __new(self, container):
+    'Internal: Returns a container created by a change, which can be changed in place'
+    if self.__shared:
+      self.__owned.add( id( container ) )
+    return container
+
+  def __groups_w(self):
+    'Internal: Returns the group name table, to be changed'
+    self.__groups = self.__own( self.__groups )
+    return self.__groups
+
+  def __hosts_w(self):
+    'Internal: Returns the host name table, to be changed'
+    self.__hosts = self.__own( self.__hosts )
+    return self.__hosts
+
+  def __group_w(self, g_id, attribute=None):
+    "Internal: Returns a group, or its 'vars', 'hosts', 'children' or 'parents', to be changed"
+    self.__group_list = self.__own( self.__group_list )
+    group = self.__group_list[g_id] = self.__own( self.__group_list[g_id] )
+    if attribute is None:
+      return group
+    value = self.__own( getattr( group, attribute ) )
+    setattr( group, attribute, value )
+    return value
+
+  def __host_w(self, h_id, attribute=None):
+    "Internal: Returns a host, or its 'groups', to be changed"
+    self.__host_list = self.__own( self.__host_list )
+    host = self.__host_list[h_id] = self.__own( self.__host_list[h_id] )
+    if attribute is None:
+      return host
+    value = self.__own( getattr( host, attribute ) )
+    setattr( host, attribute, value )
+    return value
+
+  def __host_vars_w(self, h_id):
+    'Internal: Returns the vars of a host, to be changed. They are created if the host has none'
+    host = self.__host_w( h_id )
+    if host.vars is None:
+      self.__set_host_vars( h_id, self.__new( {} ) )
     else:
-      return []
+      host.vars = self.__own( host.vars )
+    return host.vars
+
+  def __set_host_vars(self, h_id, h_vars):
+    'Internal: Replaces the vars of a host. A host that had none is moved to the end of the hostvars'
+    host = self.__host_w( h_id )
+    if host.vars is None:
+      hosts = self.__hosts_w()
+      hosts.pop( host.name )
+      hosts[ host.name ] = h_id
+    host.vars = h_vars
+
+  def __new_host(self, name, h_vars=None):
+    'Internal: Adds a host to the name tables and returns it'
+    h_id = len( self.__host_list )
+    host = self.__new( AnsibleInventory_Host( h_id, name, h_vars ) )
+    self.__new( host.groups )
+    self.__hosts_w()[name] = h_id
+    self.__host_list = self.__own( self.__host_list )
+    self.__host_list.append( host )
+    return host
+
+  def __new_group(self, name):
+    'Internal: Adds an empty group to the name tables and returns it'
+    g_id = len( self.__group_list )
+    group = self.__new( AnsibleInventory_Group( g_id, name, self.__new( {} ) ) )
+    for members in ( group.hosts, group.children, group.parents ):
+      self.__new( members )
+    self.__groups_w()[name] = g_id
+    self.__group_list = self.__own( self.__group_list )
+    self.__group_list.append( group )
+    return group
+
+  def __drop_host_if_unused(self, h_id):
+    'Internal: Removes a host from the name tables if it has no vars and is in no group, as it is not known anymore'
+    host = self.__host_list[h_id]
+    if host.vars is None and not host.groups:
+      self.__hosts_w().pop( host.name )
+      self.__host_list = self.__own( self.__host_list )
+      self.__host_list[h_id] = None
+
+  def __add_group_host(self, g_id, h_id):
+    'Internal: Appends a host to a group if it is not already there'
+    if g_id not in self.__host_list[h_id].groups:
+      self.__append_group_host( g_id, h_id )
+      self.__host_w( h_id, 'groups' ).append( g_id )
+
+  def __append_group_host(self, g_id, h_id):
+    'Internal: Appends a host to the hosts of a group, where it is not'
+    removed = self.__group_list[g_id].removed
+    if removed and h_id in removed:
+      # It is still in hosts
+      self.__compact_group_hosts( g_id, h_id )
+    self.__group_w( g_id, 'hosts' ).append( h_id )
+
+  def __del_group_host(self, g_id, h_id):
+    'Internal: Removes a host from a group. Returns False if it was not there'
+    if g_id not in self.__host_list[h_id].groups:
+      return False
+    group = self.__group_w( g_id )
+    group.removed = self.__own( group.removed ) if group.removed else self.__new( set() )
+    group.removed.add( h_id )
+    if len( group.removed ) * 2 > len( group.hosts ):
+      self.__compact_group_hosts( g_id )
+    self.__host_w( h_id, 'groups' ).remove( g_id )
+    return True
+
+  def __compact_group_hosts(self, g_id, exclude=None):
+    'Internal: Removes the removed hosts (see AnsibleInventory_Group) and exclude from the hosts of a group'
+    group = self.__group_w( g_id )
+    group.hosts = self.__new( array( 'I', ( h_id for h_id in group.host_ids() if h_id != exclude ) ) )
+    group.removed = None
+
+  def __add_group_child(self, g_id, c_id):
+    'Internal: Appends a child to a group if it is not already there'
+    if c_id not in self.__group_list[g_id].children:
+      self.__group_w( g_id, 'children' ).append( c_id )
+      self.__group_w( c_id, 'parents' ).append( g_id )
+
+  def __del_group_child(self, g_id, c_id):
+    'Internal: Removes a child from a group. Returns False if it was not there'
+    if c_id not in self.__group_list[g_id].children:
+      return False
+    self.__group_w( g_id, 'children' ).remove( c_id )
+    self.__group_w( c_id, 'parents' ).remove( g_id )
+    return True
+
+  def __group(self, group):
+    'Internal: Returns a group by name, or None if it does not exist'
+    g_id = self.__groups.get( group )
+    return None if g_id is None else self.__group_list[g_id]
+
+  def __host(self, host):
+    'Internal: Returns a host by name, or None if it is not known'
+    h_id = self.__hosts.get( host )
+    return None if h_id is None else self.__host_list[h_id]
+
+  def __host_names(self, h_ids):
+    'Internal: Returns the names of a list of host ids'
+    return [ self.__host_list[h_id].name for h_id in h_ids ]
+
+  def __group_names(self, g_ids):
+    'Internal: Returns the names of a list of group ids'
+    return [ self.__group_list[g_id].name for g_id in g_ids ]
+
+  def __get_group_hosts(self, group):
+    'Internal: Returns the list of hosts in a group'
+    g_data = self.__group( group )
+    return [] if g_data is None else self.__host_names( g_data.host_ids() )
+
+  def __selector(self, regex):
+    'Internal: Returns the selector for a regex or a list of regexes'
+    if isinstance( regex, str ):
+      return get_selector( regex )
+    return get_selector( *regex )
+
+  def __has_host(self, host):
+    'Internal: Returns True if the host is known in the inventory'
+    return host in self.__hosts
+
+  def __has_group(self, group):
+    'Internal: Returns True if the group exists'
+    return self.__groups.get( group ) is not None
 
   def __get_host_groups(self, host):
     'Internal: Returns a list of groups where a host belongs'
-    groups = []
-    for g in self.__I:
-      if g == '_meta':
-        continue
-      if host in self.__get_group_hosts(g):
-        groups.append(g)
-    return groups
+    h_data = self.__host( host )
+    return [] if h_data is None else self.__group_names( h_data.groups )
 
   def __get_group_children(self, group):
     'Internal: Returns the list of subgroups in a group'
-    if group in self.__I:
-      if isinstance( self.__I[group], dict ) and 'children' in self.__I[group]:
-        return self.__I[group]['children']
-    return []
+    g_data = self.__group( group )
+    return [] if g_data is None else self.__group_names( g_data.children )
 
   def __set_host_host(self, h_name, host):
     'Sets or replaces a host address for a host'
-    if h_name in self.__I['_meta']['hostvars']:
-      self.__I['_meta']['hostvars'][h_name]['ansible_host'] = host
-    else:
-      self.__I['_meta']['hostvars'][h_name] = { 'ansible_host': host }
+    self.__host_vars_w( self.__hosts[h_name] )['ansible_host'] = host
+    self.__record( 'set_host_var', h_name, 'ansible_host', host )
 
   def __set_host_port(self, h_name, port):
     'Sets or replaces a host address for a host'
-    if h_name in self.__I['_meta']['hostvars']:
-      self.__I['_meta']['hostvars'][h_name]['ansible_port'] = port
-    else:
-      self.__I['_meta']['hostvars'][h_name] = { 'ansible_port': port }
+    self.__host_vars_w( self.__hosts[h_name] )['ansible_port'] = port
+    self.__record( 'set_host_var', h_name, 'ansible_port', port )
 
   def __remove_group(self, g_name, from_groups=[]):
     'Removes the selected group. If from_groups is provided, the group will only removed from those groups.'
     if from_groups:
+      child = self.__group( g_name )
       for g in from_groups:
-        g_child = self.__get_group_children( g )
-        if g_name in g_child:
-          g_child.remove( g_name )
+        g_data = self.__group( g )
+        if child is not None and g_data is not None and self.__del_group_child( g_data.id, child.id ):
+          self.__record( 'del_group_child', g, g_name )
     else:
       if g_name == 'all':
         raise AnsibleInventory_Exception('Group %s cannot be removed', 'all')
-      for g in self.__I:
-        g_child = self.__get_group_children( g )
-        if g_name in g_child:
-          g_child.remove( g_name )
-      if g_name in self.__I:
-        self.__I.pop( g_name )
-      else:
+      if not self.__has_group( g_name ):
         raise AnsibleInventory_Exception('Group %s does not exist.', g_name)
+      group = self.__group( g_name )
+      for g_id in list( group.parents ):
+        self.__del_group_child( g_id, group.id )
+        self.__record( 'del_group_child', self.__group_list[g_id].name, g_name )
+      # It may have been copied (and it is not a child of itself anymore)
+      group = self.__group_list[group.id]
+      for h_id in group.host_ids():
+        self.__host_w( h_id, 'groups' ).remove( group.id )
+        self.__drop_host_if_unused( h_id )
+      for c_id in group.children:
+        self.__group_w( c_id, 'parents' ).remove( group.id )
+      self.__groups_w().pop( g_name )
+      self.__group_list = self.__own( self.__group_list )
+      self.__group_list[group.id] = None
+      self.__record( 'del_group', g_name )
 
   def __add_group_to_groups(self, group, g_regex):
     'Adds a single group to groups matching g_regex'
-    self.next_from_cache()
-    if group not in self.list_groups():
+    if not self.__has_group( group ):
       raise AnsibleInventory_Exception('Group %s does not exist', targets=group)
 
-    self.next_from_cache()
     matching_groups = self.list_groups( g_regex )
     if not matching_groups:
       raise AnsibleInventory_Exception('No group matches your selection')
 
+    c_id = self.__groups[group]
     for g in matching_groups:
-      if isinstance( self.__I[g], list):
-        hosts = self.__I[g]
-        self.__I[g] = {
-          'hosts': hosts,
-          'vars': {},
-          'children': []
-        }
-      elif isinstance( self.__I[g], dict) and 'children' not in self.__I[g]:
-        self.__I[g]['children'] = []
-
-      if group not in self.__I[g]['children']:
-        self.__I[g]['children'].append( group )
+      self.__add_group_child( self.__groups[g], c_id )
+      self.__record( 'add_group_child', g, group )
 
   def __parse_var( self, raw_value ):
     'Parses a var and returns a string, a list or a dict'
+    import ast
     try:
       v_value = ast.literal_eval( raw_value )
     except Exception:
       v_value = raw_value
     return v_value
 
-  @inv_read
   def get_ansible_json(self):
     'Returns the ansible json'
-    return json.dumps( self.__I )
+    return self.get_ansible_json_bytes()[1].decode("utf-8")
+
+  def get_ansible_json_bytes(self):
+    'Returns the etag and the ansible json encoded in utf-8 (see write_ansible_json)'
+    stream = io.BytesIO()
+    etag = self.write_ansible_json( stream )
+    return etag, stream.getvalue()
+
+  def write_ansible_json(self, stream):
+    """Writes the ansible json encoded in utf-8 to a binary stream, in chunks, and returns its etag (a hash of the
+    contents). The backend stores it for the current version of the inventory, so it is only encoded again
+    after the inventory changes"""
+    if not self.write_level and not ( self.from_cache and self.is_loaded() ):
+      try:
+        stored = self.backend.open_ansible_json( self.backend.get_version() )
+      except Exception as e:
+        raise AnsibleInventory_Exception( e.__str__() )
+      if stored is not None:
+        etag, json_file = stored
+        with json_file:
+          shutil.copyfileobj( json_file, stream )
+        self.from_cache = False
+        return etag
+    return self.__write_ansible_json( stream )
 
   @inv_read
+  def __write_ansible_json(self, stream):
+    'Internal: Writes the ansible json of the loaded inventory to stream while the backend stores it'
+    # With changes that are not saved yet it does not belong to any version, so it is not stored
+    version = None if self.write_level else self.__version
+    return self.backend.save_ansible_json( version, self.__encode_ansible_json( self.__serialize(), stream ) )
+
+  def __encode_ansible_json(self, inventory, stream=None):
+    'Internal: Yields the ansible json of the (serialized) inventory in chunks encoded in utf-8, writing them to stream too'
+    for chunk in iterencode_json( inventory ):
+      chunk = chunk.encode("utf-8")
+      if stream is not None:
+        stream.write( chunk )
+      yield chunk
+
   def get_ansible_host_json(self, host):
-    'Returns the ansible json for a host'
-    if host in self.__I['_meta']['hostvars']:
-      return json.dumps( self.__I['_meta']['hostvars'][ host ] )
+    'Returns the ansible json for a host. If the inventory was not loaded yet, only the host vars are read from the backend'
+    if self.is_loaded():
+      return self.__get_ansible_host_json( host )
+    try:
+      return json.dumps( self.backend.load_host_vars( host ) )
+    except Exception as e:
+      raise AnsibleInventory_Exception( e.__str__() )
+
+  @inv_read
+  def __get_ansible_host_json(self, host):
+    'Internal: Returns the ansible json for a host from the loaded inventory'
+    h_data = self.__host( host )
+    if h_data is not None and h_data.vars is not None:
+      return json.dumps( h_data.vars )
     return json.dumps( {} )
 
   @inv_read
   def list_hosts(self, h_regex='.*'):
-    'Returns a list of known hosts in the inventory. If regex specified only matching hosts will be returned'
-    hosts = []
-    for g in self.__I:
-      if g == '_meta':
-        for h in self.__I['_meta']['hostvars']:
-          if h not in hosts and fullmatch( h_regex, h ):
-            hosts.append( h )
+    'Returns a list of known hosts in the inventory. If regex (or a list of regexes) specified only matching hosts will be returned'
+    selector = self.__selector( h_regex )
+    if selector.is_literal():
+      return [ h for h in selector.literals if self.__has_host( h ) ]
+    hosts = {}
+    for g, g_id in self.__groups.items():
+      if g_id is None:
+        hosts.update( ( h, None ) for h, h_id in self.__hosts.items() if self.__host_list[h_id].vars is not None )
       else:
-        h_list = self.__get_group_hosts( g )
-        if h_list:
-          for h in h_list:
-            if h not in hosts and fullmatch( h_regex, h ):
-              hosts.append( h )
-    return hosts
+        hosts.update( dict.fromkeys( self.__host_names( self.__group_list[g_id].host_ids() ) ) )
+    return selector.filter( hosts )
 
   @inv_read
   def list_groups(self, g_regex='.*'):
-    'Returns a list of available groups. If g_regex is specified, only matching groups will be returned'
-    groups = []
-    for g in self.__I:
-      if g == '_meta':
-        continue
-      if fullmatch( g_regex, g ):
-        groups.append(g)
-    return groups
+    'Returns a list of available groups. If g_regex (or a list of regexes) is specified, only matching groups will be returned'
+    return [ g for g in self.__selector( g_regex ).filter( self.__groups ) if g != '_meta' ]
 
   @inv_read
   def list_vars( self, v_regex='.*' ):
     'Returns a list of variables in the inventory. If regex specified only matching variables will be returned.'
-    i_vars = []
-    for g in self.__I:
-      if g == '_meta':
-        for h in self.__I['_meta']['hostvars']:
-          for v in self.__I['_meta']['hostvars'][ h ]:
-            if v not in i_vars and fullmatch( v_regex, v ):
-              i_vars.append( v )
+    i_vars = {}
+    for g, g_id in self.__groups.items():
+      if g_id is None:
+        for h_id in self.__hosts.values():
+          i_vars.update( dict.fromkeys( self.__host_list[h_id].vars or () ) )
       else:
-        for v in self.__I[ g ]['vars']:
-          if v not in i_vars and fullmatch( v_regex, v ):
-            i_vars.append( v )
-    return i_vars
+        i_vars.update( dict.fromkeys( self.__group_list[g_id].vars ) )
+    return self.__selector( v_regex ).filter( i_vars )
 
   @inv_read
   def get_group_vars(self, group):
     'Returns a dict with the group vars'
-    if group in self.__I:
-      if isinstance( self.__I[group], dict):
-        if 'vars' in self.__I[group]:
-          return self.__I[group]['vars']
+    g_data = self.__group( group )
+    if g_data is not None:
+      return g_data.vars
     return {}
 
   @inv_read
@@ -273,17 +724,15 @@ class AnsibleInventory:
   @inv_read
   def get_group_parents(self, group):
     'Returns a list of the group parents of group'
-    g_parents = []
-    for g in self.__I:
-      if isinstance( self.__I[g], dict ) and 'children' in self.__I[g] and group in self.__I[g]['children']:
-        g_parents.append(g)
-    return g_parents
+    g_data = self.__group( group )
+    return [] if g_data is None else self.__group_names( g_data.parents )
 
   @inv_read
   def get_host_vars(self, host):
     'Returns a dict with the host vars'
-    if host in self.__I['_meta']['hostvars']:
-      return self.__I['_meta']['hostvars'][host]
+    h_data = self.__host( host )
+    if h_data is not None and h_data.vars is not None:
+      return h_data.vars
     else:
       return {}
 
@@ -297,7 +746,7 @@ class AnsibleInventory:
     'Checks if a host has a variable with v_name with a matching value of v_value_regex'
     self.next_from_cache()
     h_vars = self.get_host_vars( host )
-    if v_name in h_vars and fullmatch( v_value_regex, str(h_vars[v_name]) ):
+    if v_name in h_vars and get_selector( v_value_regex ).match( str(h_vars[v_name]) ):
       return True
     return False
 
@@ -306,44 +755,40 @@ class AnsibleInventory:
     'Checks if a group has a variable with v_name with a matching value of v_value_regex'
     self.next_from_cache()
     g_vars = self.get_group_vars( group )
-    if v_name in g_vars and fullmatch( v_value_regex, str(g_vars[v_name]) ):
+    if v_name in g_vars and get_selector( v_value_regex ).match( str(g_vars[v_name]) ):
       return True
     return False
 
   @inv_write
   def add_hosts_to_groups(self, h_regex, g_regex_list):
     'Adds a hosts matching h_regex to groups matching g_regex from a list'
-    self.next_from_cache()
     matching_hosts = self.list_hosts( h_regex )
     if not matching_hosts:
       raise AnsibleInventory_Exception('No host matches your selection')
 
     matching_groups = []
     for g_regex in g_regex_list:
-      self.next_from_cache()
       m_groups = self.list_groups( g_regex )
       if not m_groups:
         raise AnsibleInventory_Exception("No group matches '%s'" % g_regex)
       matching_groups += m_groups
 
-    for h_name in matching_hosts:
-      for g_name in matching_groups:
-        if isinstance( self.__I[ g_name ], list ):
-          if h_name not in self.__I[ g_name ]:
-            self.__I[ g_name ].append( h_name )
-        elif isinstance( self.__I[ g_name ], dict ):
-          if h_name not in self.__I[ g_name ]['hosts']:
-            self.__I[ g_name ]['hosts'].append( h_name )
+    for g_name in matching_groups:
+      g_id = self.__groups[ g_name ]
+      for h_name in matching_hosts:
+        self.__add_group_host( g_id, self.__hosts[ h_name ] )
+        self.__record( 'add_group_host', g_name, h_name )
 
   @inv_write
   def add_host(self, h_name, h_host=None, h_port=None ):
     'Adds a host'
-    self.next_from_cache()
-    if h_name in self.list_hosts():
+    if self.__has_host( h_name ):
       raise AnsibleInventory_Exception('Host %s already exists', h_name)
     else:
-      self.__I['all']['hosts'].append( h_name )
-      self.__I['_meta']['hostvars'][ h_name ] = {}
+      host = self.__new_host( h_name, self.__new( {} ) )
+      self.__add_group_host( self.__groups['all'], host.id )
+      self.__record( 'add_host', h_name )
+      self.__record( 'add_group_host', 'all', h_name )
 
     if h_host:
       self.__set_host_host( h_name, h_host )
@@ -353,12 +798,9 @@ class AnsibleInventory:
   @inv_write
   def add_group(self, group):
     'Adds a group'
-    if group not in self.__I:
-      self.__I[ group ] = {
-        'hosts': [],
-        'vars': {},
-        'children': []
-      }
+    if group not in self.__groups:
+      self.__new_group( group )
+      self.__record( 'add_group', group )
     else:
       raise AnsibleInventory_Exception('Group %s already exists', group)
 
@@ -367,126 +809,120 @@ class AnsibleInventory:
     'Adds a single group to groups matching g_regex'
     return self.__add_group_to_groups(group, g_regex)
 
-  @inv_write
   def edit_host_vars(self, h_name, callback):
-    'Edits host vars by calling "callback( vars_dict )". It locks the inventory until callback returns with a new "vars_dict" with the new vars.'
-    self.next_from_cache()
-    hosts = self.list_hosts()
-    if h_name not in hosts:
+    """Edits host vars by calling "callback( vars_dict )", which returns a new "vars_dict" with the new vars. The
+    callback is called only once: if someone else saves the inventory before the new vars, they are set over it"""
+    h_vars = self.__copy_host_vars( h_name )
+    if h_vars is None:
       raise AnsibleInventory_Exception('Host %s does not exist', h_name)
 
-    if h_name in self.__I['_meta']['hostvars']:
-      h_vars = self.__I['_meta']['hostvars'][h_name]
-    else:
-      h_vars = {}
-
     new_vars = callback( h_vars )
 
     if new_vars and isinstance(new_vars, dict):
-      self.__I['_meta']['hostvars'][h_name] = new_vars
+      self.__replace_host_vars( h_name, new_vars )
+
+  @inv_read
+  def __copy_host_vars(self, h_name):
+    'Internal: Returns a copy of the host vars (as they may be shared with a snapshot), or None if it does not exist'
+    h_data = self.__host( h_name )
+    return None if h_data is None else dict( h_data.vars or {} )
 
   @inv_write
+  def __replace_host_vars(self, h_name, new_vars):
+    'Internal: Replaces all the vars of a host'
+    if not self.__has_host( h_name ):
+      raise AnsibleInventory_Exception('Host %s does not exist', h_name)
+    self.__set_host_vars( self.__hosts[h_name], new_vars )
+    self.__record( 'set_host_vars', h_name, dict( new_vars ) )
+
   def edit_group_vars(self, g_name, callback):
-    'Edits group vars by calling "callback( vars_dict )". It locks the inventory until callback returns with a new "vars_dict" with the new vars.'
-    self.next_from_cache()
-    groups = self.list_groups()
-    if g_name not in groups:
+    """Edits group vars by calling "callback( vars_dict )", which returns a new "vars_dict" with the new vars. The
+    callback is called only once: if someone else saves the inventory before the new vars, they are set over it"""
+    g_vars = self.__copy_group_vars( g_name )
+    if g_vars is None:
       raise AnsibleInventory_Exception('Group %s does not exist', g_name)
 
-    if isinstance( self.__I[g_name], list):
-      hosts = self.__I[g_name]
-      self.__I[g_name] = {
-        'hosts': hosts,
-        'vars': {},
-        'children': []
-      }
-    elif isinstance( self.__I[g_name], dict) and 'vars' not in self.__I[g_name]:
-      self.__I[g_name]['vars'] = {}
-
-    g_vars = self.__I[g_name]['vars']
-
     new_vars = callback( g_vars )
 
     if new_vars and isinstance(new_vars, dict):
-      self.__I[g_name]['vars'] = new_vars
+      self.__replace_group_vars( g_name, new_vars )
+
+  @inv_read
+  def __copy_group_vars(self, g_name):
+    'Internal: Returns a copy of the group vars (as they may be shared with a snapshot), or None if it does not exist'
+    g_data = self.__group( g_name )
+    return None if g_data is None else dict( g_data.vars )
+
+  @inv_write
+  def __replace_group_vars(self, g_name, new_vars):
+    'Internal: Replaces all the vars of a group'
+    if not self.__has_group( g_name ):
+      raise AnsibleInventory_Exception('Group %s does not exist', g_name)
+    self.__group_w( self.__groups[g_name] ).vars = new_vars
+    self.__record( 'set_group_vars', g_name, dict( new_vars ) )
 
   @inv_write
   def add_var_to_groups(self, v_name, raw_value, g_regex):
     'Adds a variable a to groups matching g_regex'
-    self.next_from_cache()
     matching_groups = self.list_groups( g_regex )
     if not matching_groups:
       raise AnsibleInventory_Exception('No group matches your selection')
 
-    v_value = self.__parse_var( raw_value )
-    exist_in = []
-    for g in matching_groups:
-      if isinstance( self.__I[g], list):
-        hosts = self.__I[g]
-        self.__I[g] = {
-          'hosts': hosts,
-          'vars': {},
-          'children': []
-        }
-      elif isinstance( self.__I[g], dict) and 'vars' not in self.__I[g]:
-        self.__I[g]['vars'] = {}
-
-      if v_name not in self.__I[g]['vars']:
-        self.__I[g]['vars'][v_name] = v_value
-      else:
-        exist_in.append( g )
-
+    exist_in = [ g for g in matching_groups if v_name in self.__group( g ).vars ]
     if exist_in:
       str_list = '%s ' * exist_in.__len__()
       raise AnsibleInventory_Exception('Var %s already exist in these groups: '+str_list, targets=(v_name,)+tuple( exist_in ) )
 
+    v_value = self.__parse_var( raw_value )
+    for g in matching_groups:
+      self.__group_w( self.__groups[g], 'vars' )[v_name] = v_value
+      self.__record( 'set_group_var', g, v_name, v_value )
+
   @inv_write
   def add_var_to_hosts(self, v_name, raw_value, h_regex):
     'Adds a variable to hosts matching h_regex'
-    self.next_from_cache()
     matching_hosts = self.list_hosts( h_regex )
     if not matching_hosts:
       raise AnsibleInventory_Exception('No host matches your selection')
 
-    v_value = self.__parse_var( raw_value )
-    exist_in = []
-    for h in matching_hosts:
-      if h not in self.__I['_meta']['hostvars']:
-        self.__I['_meta']['hostvars'][h] = {v_name : v_value}
-      elif v_name not in self.__I['_meta']['hostvars'][h]:
-        self.__I['_meta']['hostvars'][h][v_name] = v_value
-      else:
-        exist_in.append( h )
+    exist_in = [ h for h in matching_hosts if v_name in ( self.__host( h ).vars or () ) ]
     if exist_in:
       str_list = '%s ' * exist_in.__len__()
       raise AnsibleInventory_Exception('Var %s already exist in these hosts: '+str_list, targets=(v_name,)+tuple( exist_in ) )
 
+    v_value = self.__parse_var( raw_value )
+    for h in matching_hosts:
+      self.__host_vars_w( self.__hosts[h] )[v_name] = v_value
+      self.__record( 'set_host_var', h, v_name, v_value )
+
   @inv_write
   def rename_host(self, h_name, new_name):
     'Renames a host'
-    self.next_from_cache()
-    hosts = self.list_hosts()
-    if new_name in hosts:
+    if self.__has_host( new_name ):
       raise AnsibleInventory_Exception('Host %s already exists', new_name)
-    if h_name not in hosts:
+    if not self.__has_host( h_name ):
       raise AnsibleInventory_Exception('Host %s does not exist', h_name)
 
-    if h_name in self.__I['_meta']['hostvars']:
-      hvars = self.__I['_meta']['hostvars'].pop(h_name)
-      self.__I['_meta']['hostvars'][new_name] = hvars
-    for g in self.__get_host_groups( h_name ):
-      if isinstance( self.__I[g], list ):
-        self.__I[g].remove( h_name )
-        self.__I[g].append( new_name )
-      elif isinstance( self.__I[g], dict):
-        self.__I[g]['hosts'].remove( h_name )
-        self.__I[g]['hosts'].append( new_name )
+    hosts = self.__hosts_w()
+    h_id = hosts.pop( h_name )
+    hosts[ new_name ] = h_id
+    host = self.__host_w( h_id )
+    host.name = new_name
+    if host.vars is not None:
+      self.__record( 'del_host', h_name )
+      self.__record( 'set_host_vars', new_name, dict( host.vars ) )
+    for g_id in host.groups:
+      # The renamed host goes to the end of its groups
+      self.__compact_group_hosts( g_id, h_id )
+      self.__append_group_host( g_id, h_id )
+      g = self.__group_list[g_id].name
+      self.__record( 'del_group_host', g, h_name )
+      self.__record( 'add_group_host', g, new_name )
 
   @inv_write
   def change_host(self, h_name, h_host=None, h_port=None):
     'Changes the host address or port of a host'
-    self.next_from_cache()
-    if h_name not in self.list_hosts():
+    if not self.__has_host( h_name ):
       raise AnsibleInventory_Exception('Host %s does not exist', h_name)
     if h_host:
       self.__set_host_host( h_name, h_host )
@@ -496,68 +932,88 @@ class AnsibleInventory:
   @inv_write
   def rename_host_var(self, v_name, new_name, h_regex):
     'Renames a variable in a set of hosts matching a regular expression'
-    self.next_from_cache()
-    for h in self.list_hosts():
-      if fullmatch( h_regex, h ) and h in self.__I['_meta']['hostvars'] and v_name in self.__I['_meta']['hostvars'][h]:
-        v_value = self.__I['_meta']['hostvars'][h].pop(v_name)
-        self.__I['_meta']['hostvars'][h][new_name] = v_value
+    for h in self.list_hosts( h_regex ):
+      if v_name in ( self.__host( h ).vars or () ):
+        h_vars = self.__host_vars_w( self.__hosts[h] )
+        v_value = h_vars.pop(v_name)
+        h_vars[new_name] = v_value
+        self.__record( 'del_host_var', h, v_name )
+        self.__record( 'set_host_var', h, new_name, v_value )
 
   @inv_write
   def change_host_var(self, v_name, raw_value, h_regex):
     'Changes the value of a variable in the hosts matching a regular expression in case it is defined'
-    self.next_from_cache()
-    for h in self.list_hosts():
-      if fullmatch( h_regex, h ) and h in self.__I['_meta']['hostvars'] and v_name in self.__I['_meta']['hostvars'][h]:
-        self.__I['_meta']['hostvars'][h][v_name] = self.__parse_var( raw_value )
+    for h in self.list_hosts( h_regex ):
+      if v_name in ( self.__host( h ).vars or () ):
+        h_vars = self.__host_vars_w( self.__hosts[h] )
+        h_vars[v_name] = self.__parse_var( raw_value )
+        self.__record( 'set_host_var', h, v_name, h_vars[v_name] )
 
   @inv_write
   def rename_group(self, g_name, new_name):
     'Renames a group'
-    if new_name in self.__I:
+    if new_name in self.__groups:
       raise AnsibleInventory_Exception('Group %s already exists', new_name)
-    if g_name not in self.__I:
+    if not self.__has_group( g_name ):
       raise AnsibleInventory_Exception('Group %s does not exist', g_name)
-    g_data = self.__I.pop(g_name)
-    self.__I[new_name] = g_data
-    self.save()
-    for g_parent in self.get_group_parents( g_name ):
-      self.__remove_group( g_name, from_groups=[g_parent] )
-      self.__add_group_to_groups( new_name, g_parent )
+    groups = self.__groups_w()
+    g_id = groups.pop(g_name)
+    groups[new_name] = g_id
+    group = self.__group_w( g_id )
+    group.name = new_name
+    self.__record( 'del_group', g_name )
+    self.__record( 'add_group', new_name )
+    self.__record( 'set_group_vars', new_name, dict( group.vars ) )
+    for h in self.__host_names( group.host_ids() ):
+      self.__record( 'add_group_host', new_name, h )
+    for c in self.__group_names( group.children ):
+      self.__record( 'add_group_child', new_name, c )
+    for g_parent in self.__group_names( group.parents ):
+      # The renamed child keeps its position
+      self.__record( 'set_group_children', g_parent, self.__get_group_children( g_parent ) )
 
   @inv_write
   def rename_group_var(self, v_name, new_name, g_regex):
     'Renames a variable in a set of groups matching a regular expression'
-    for g in self.__I:
+    for g in self.__selector( g_regex ).filter( self.__groups ):
       if g == '_meta':
         continue
-      if fullmatch( g_regex, g ) and isinstance( self.__I[g], dict) and 'vars' in self.__I[g]:
-        if v_name in self.__I[g]['vars']:
-          v_value = self.__I[g]['vars'].pop(v_name)
-          self.__I[g]['vars'][new_name] = v_value
+      if v_name in self.__group( g ).vars:
+        g_vars = self.__group_w( self.__groups[g], 'vars' )
+        v_value = g_vars.pop(v_name)
+        g_vars[new_name] = v_value
+        self.__record( 'del_group_var', g, v_name )
+        self.__record( 'set_group_var', g, new_name, v_value )
 
   @inv_write
   def change_group_var(self, v_name, raw_value, g_regex):
     'Changes the value of a variable in the groups matching a regular expression in case it is defined'
-    for g in self.__I:
+    for g in self.__selector( g_regex ).filter( self.__groups ):
       if g == '_meta':
         continue
-      if fullmatch( g_regex, g ) and isinstance( self.__I[g], dict) and 'vars' in self.__I[g]:
-        if v_name in self.__I[g]['vars']:
-          self.__I[g]['vars'][v_name] = self.__parse_var( raw_value )
+      if v_name in self.__group( g ).vars:
+        g_vars = self.__group_w( self.__groups[g], 'vars' )
+        g_vars[v_name] = self.__parse_var( raw_value )
+        self.__record( 'set_group_var', g, v_name, g_vars[v_name] )
 
   @inv_write
   def remove_host(self, h_name, from_groups=[]):
     'Removes the selected host. If from_groups is provided, the host will only removed from those groups.'
+    host = self.__host( h_name )
+    if host is None:
+      return
     if from_groups:
       groups = from_groups
     else:
       groups = self.__get_host_groups( h_name )
-      if h_name in self.__I['_meta']['hostvars']:
-        self.__I['_meta']['hostvars'].pop(h_name)
+      if host.vars is not None:
+        self.__host_w( host.id ).vars = None
+        self.__record( 'del_host', h_name )
     for g in groups:
-      g_hosts = self.__get_group_hosts( g )
-      if g_hosts and h_name in g_hosts:
-        g_hosts.remove( h_name )
+      g_data = self.__group( g )
+      if g_data is not None and self.__del_group_host( g_data.id, host.id ):
+        self.__record( 'del_group_host', g, h_name )
+    self.__drop_host_if_unused( host.id )
 
   @inv_write
   def remove_group(self, g_name, from_groups=[]):
@@ -567,11 +1023,15 @@ class AnsibleInventory:
   @inv_write
   def remove_host_var(self, v_name, h_name ):
     'Removes a variable from a host'
-    if h_name in self.__I['_meta']['hostvars'] and v_name in self.__I['_meta']['hostvars'][h_name]:
-      self.__I['_meta']['hostvars'][h_name].pop( v_name )
+    h_data = self.__host( h_name )
+    if h_data is not None and v_name in ( h_data.vars or () ):
+      self.__host_vars_w( h_data.id ).pop( v_name )
+      self.__record( 'del_host_var', h_name, v_name )
 
   @inv_write
   def remove_group_var(self, v_name, g_name):
     'Removes a variable from a group'
-    if g_name in self.__I and 'vars' in self.__I[g_name] and v_name in self.__I[g_name]['vars']:
-      self.__I[g_name]['vars'].pop( v_name )
+    g_data = self.__group( g_name )
+    if g_data is not None and v_name in g_data.vars:
+      self.__group_w( g_data.id, 'vars' ).pop( v_name )
+      self.__record( 'del_group_var', g_name, v_name )
@@ -1,24 +1,114 @@
 # -*- coding:utf-8 -*-
 # vim: set ts=2 sw=2 sts=2 et:
 
+# Modules that are not needed to answer ansible (--list and --host) from a stored inventory are imported where they
+# are used
+import itertools
 import json
 import os
 import time
-import uuid
-from ansible_inventory.lib import AnsibleInventory_Exception, SimpleFlock
+from contextlib import contextmanager
+from ansible_inventory.lib import AnsibleInventory_Exception, AnsibleInventory_ConflictException, SimpleFlock, atomic_open, file_permissions, iterencode_json
 
 
 class AnsibleInventory_Backend:
 
+    # Backends that can save just the changes (see apply_delta) set this to True
+    partial_saves = False
+
+    # File where the ansible json of the inventory is stored along with its version (see save_ansible_json), if any
+    ansible_json_path = None
+
+    # Permissions of the file where the ansible json is stored (reduced by the umask). It has all the vars of the
+    # inventory, which may have secrets, so backends with an inventory file give it the permissions of that file
+    ansible_json_permissions = 0o600
+
     def __init__( self, backend_parameters, config ):
       self.__lock = None
 
     def load_inventory( self ):
       raise AnsibleInventory_Exception( "backend.load_inventory: Not implemented" )
 
-    def save_inventory( self ):
+    def save_inventory( self, inventory ):
+      "Saves the inventory. It may return the new version token (see get_version), otherwise get_version is called"
       raise AnsibleInventory_Exception( "backend.save_inventory: Not implemented" )
 
+    def apply_delta( self, delta ):
+      "Saves a list of changes, as the delta operations described in AnsibleInventory.__record. Returns like save_inventory"
+      raise AnsibleInventory_Exception( "backend.apply_delta: Not implemented" )
+
+    def load_host_vars( self, host ):
+      "Returns the vars of a single host. Backends that can read them without loading the whole inventory override this"
+      return self.load_inventory().get( '_meta', {} ).get( 'hostvars', {} ).get( host, {} )
+
+    def get_version( self ):
+      "Returns a cheap token that changes whenever the stored inventory changes. None means unknown, so the inventory is always loaded"
+      return None
+
+    def open_ansible_json( self, version ):
+      "Returns the etag and the file with the ansible json stored for version, opened in binary mode where the json starts, or None if there is none for it"
+      if self.ansible_json_path is None or version is None:
+        return None
+      try:
+        json_file = open( self.ansible_json_path, 'rb' )
+      except OSError:
+        return None
+      try:
+        etag = json_file.readline().rstrip( b'\n' ).decode("utf-8")
+        if json_file.readline() == json.dumps( version ).encode("utf-8") + b'\n':
+          return etag, json_file
+      except OSError:
+        pass
+      json_file.close()
+      return None
+
+    def save_ansible_json( self, version, chunks ):
+      """Stores the ansible json of the inventory with version, as it is read from chunks (an iterator of bytes), and
+      returns its etag. All the chunks are read even if it cannot be stored. The first line of the file is the
+      etag (written at the end), the second one the version and then the json"""
+      import hashlib
+      etag = hashlib.sha1()
+      json_file = None
+      if self.ansible_json_path is not None and version is not None:
+        try:
+          os.makedirs( os.path.dirname( self.ansible_json_path ), exist_ok=True )
+          tmp_path = '%s.%s.tmp' % ( self.ansible_json_path, os.urandom( 8 ).hex() )
+          json_file = open( tmp_path, 'xb', opener=lambda path, flags: os.open( path, flags, self.ansible_json_permissions ) )
+          json_file.write( b' ' * etag.digest_size * 2 + b'\n' + json.dumps( version ).encode("utf-8") + b'\n' )
+        except OSError:
+          json_file = self.__discard( json_file )
+      try:
+        for chunk in chunks:
+          etag.update( chunk )
+          if json_file is not None:
+            try:
+              json_file.write( chunk )
+            except OSError:
+              json_file = self.__discard( json_file )
+        if json_file is not None:
+          try:
+            json_file.seek( 0 )
+            json_file.write( etag.hexdigest().encode("utf-8") )
+            json_file.close()
+            os.replace( json_file.name, self.ansible_json_path )
+            json_file = None
+          except OSError:
+            pass
+      finally:
+        # It is just an optimization, so it is given up on any error
+        self.__discard( json_file )
+      return etag.hexdigest()
+
+    def __discard( self, tmp_file ):
+      "Closes and removes a temporary file, if any. Returns None"
+      if tmp_file is not None:
+        try:
+          tmp_file.close()
+          os.unlink( tmp_file.name )
+        except OSError:
+          pass
+      return None
+
     def lock( self ):
       raise AnsibleInventory_Exception( "backend.lock: Not implemented" )
 
@@ -26,42 +116,347 @@ class AnsibleInventory_Backend:
       raise AnsibleInventory_Exception( "backend.unlock: Not implemented" )
 
 
+class AnsibleInventory_SnapshotBackend( AnsibleInventory_Backend ):
+  """Backend of the snapshots of an inventory (see AnsibleInventory.snapshot). Snapshots are read only and their
+  version never changes, so they are never loaded again. Their ansible json is the one stored by the backend of
+  the inventory for the same version"""
+
+  def __init__( self, backend, version ):
+    self.backend = backend
+    self.source_version = version
+    # None would mean an unknown version, which is always loaded again
+    self.version = ( version, )
+
+  def get_version( self ):
+    return self.version
+
+  def open_ansible_json( self, version ):
+    return self.backend.open_ansible_json( self.source_version )
+
+  def save_ansible_json( self, version, chunks ):
+    return self.backend.save_ansible_json( self.source_version, chunks )
+
+  def lock( self ):
+    raise AnsibleInventory_Exception( "Snapshots can not be changed" )
+
+  def unlock( self ):
+    pass
+
+
+class AnsibleInventory_ImportBackend( AnsibleInventory_Backend ):
+  """Backend of an inventory that is already loaded (i.e. from the file given to --import). It is read only and
+  it does not lock anything"""
+
+  def __init__( self, inventory ):
+    self.inventory = inventory
+
+  def load_inventory( self ):
+    return self.inventory
+
+  def lock( self ):
+    raise AnsibleInventory_Exception( "Imported inventories can not be changed" )
+
+  def unlock( self ):
+    pass
+
+
 class AnsibleInventory_FileBackend( AnsibleInventory_Backend ):
-  "Backend class for ansible-inventory that uses a json file for storage"
+  """Backend class for ansible-inventory that uses a json file for storage.
+  With journal = True changes are appended to <path>.journal, one json line per save with the delta operations (see
+  AnsibleInventory.__record), so saving does not rewrite the whole inventory. Loads apply the journal over the
+  inventory file. When the journal grows over journal_max_size bytes or journal_max_records saves, it is compacted:
+  the inventory file is rewritten with the journal applied and the journal is moved to <path>.journal.old.
+  The vars of a host (--host) are read from an index of host vars, a sqlite database built from the inventory
+  the first time they are read after it changes."""
 
   def __init__( self, backend_parameters, config ):
-    self.lockfile = '/tmp/.ansible-inventory_file_backend.lock'
-    self.__lock = SimpleFlock('/tmp/.ansible-inventory_file_backend_main.lock',
-                              timeout=3)
-
     self.json_path = os.path.expanduser(
       backend_parameters['path'].strip('"\'')
     )
     if not os.path.isabs( self.json_path ):
       self.json_path = os.path.join( config.config_home, self.json_path )
 
+    # Lock files live next to the inventory, so different inventories do not contend.
+    # lockfile guards the inventory file itself (shared for loads, exclusive for saves)
+    # and the main lock serializes the writers (see lock() and unlock()).
+    lock_prefix = os.path.join( os.path.dirname( self.json_path ), '.' + os.path.basename( self.json_path ) )
+    self.lockfile = lock_prefix + '.lock'
+    self.ansible_json_path = lock_prefix + '.list'
+    self.hostvars_path = lock_prefix + '.hostvars'
+    self.__lock = SimpleFlock( lock_prefix + '.main.lock', timeout=3 )
+
     if 'pretty' in backend_parameters and backend_parameters['pretty'].lower() in ("true", "1", "yes", "on"):
       self.pretty = True
     else:
       self.pretty = False
 
+    self.journal_path = self.json_path + '.journal'
+    self.journal = False
+    self.journal_max_size = 1048576
+    self.journal_max_records = 1000
+    if 'journal' in backend_parameters and backend_parameters['journal']:
+      self.journal = backend_parameters['journal'].lower() in ("true", "1", "yes", "on")
+    if 'journal_max_size' in backend_parameters and backend_parameters['journal_max_size']:
+      self.journal_max_size = int( backend_parameters['journal_max_size'] )
+    if 'journal_max_records' in backend_parameters and backend_parameters['journal_max_records']:
+      self.journal_max_records = int( backend_parameters['journal_max_records'] )
+    self.partial_saves = self.journal
+
+  @property
+  def ansible_json_permissions(self):
+    "The files with the contents of the inventory get the permissions of the inventory file"
+    return file_permissions( self.json_path, 0o600 )
+
+  @contextmanager
+  def __read_lock(self):
+    "Takes the inventory file lock in shared mode, so readers do not block each other"
+    try:
+      lock = SimpleFlock( self.lockfile, timeout=3, shared=True ).__enter__()
+    except PermissionError:
+      # The lock file cannot be created (i.e. read only directory). Reading without
+      # it is still safe because the inventory file is always replaced atomically
+      yield
+      return
+    try:
+      yield
+    finally:
+      lock.__exit__()
+
   def load_inventory(self):
     "Returns a dictionary with the inventory contents as required by Inventory class"
-    if os.path.exists( self.json_path ):
-      with SimpleFlock( self.lockfile, timeout=3 ):
-        with open( self.json_path ) as inv_file:
-          return json.loads( inv_file.read() )
-    else:
-        return {}
+    with self.__read_lock():
+      return self.__read_inventory()
+
+  def __read_inventory(self):
+    "Reads the inventory file and applies the journal"
+    try:
+      with open( self.json_path ) as inv_file:
+        inventory = json.loads( inv_file.read() )
+    except FileNotFoundError:
+      inventory = {}
+    if self.journal:
+      self.__replay_journal( inventory )
+    return inventory
+
+  def __replay_journal(self, inventory):
+    "Applies the delta operations in the journal to inventory"
+    try:
+      with open( self.journal_path ) as journal:
+        lines = journal.readlines()
+    except FileNotFoundError:
+      return
+    if not lines:
+      return
+
+    # Groups are converted to the internal format (with ordered sets) while the operations are applied
+    hostvars = inventory.setdefault( '_meta', {} ).setdefault( 'hostvars', {} )
+    groups = {}
+    for g in inventory:
+      if g != '_meta':
+        g_data = inventory[g] if isinstance( inventory[g], dict ) else { 'hosts': inventory[g] }
+        groups[g] = {
+          'hosts': dict.fromkeys( g_data.get( 'hosts' ) or () ),
+          'vars': g_data.get( 'vars' ) or {},
+          'children': dict.fromkeys( g_data.get( 'children' ) or () )
+        }
+
+    def group(name):
+      return groups.setdefault( name, { 'hosts': {}, 'vars': {}, 'children': {} } )
+
+    for line in lines:
+      try:
+        delta = json.loads( line )['ops']
+      except ( ValueError, KeyError ):
+        # A record that was not completely written, so its save did not succeed
+        continue
+      for operation, *args in delta:
+        if operation == 'add_host':
+          hostvars.setdefault( args[0], {} )
+        elif operation == 'del_host':
+          hostvars.pop( args[0], None )
+        elif operation == 'set_host_var':
+          hostvars.setdefault( args[0], {} )[ args[1] ] = args[2]
+        elif operation == 'del_host_var':
+          hostvars.get( args[0], {} ).pop( args[1], None )
+        elif operation == 'set_host_vars':
+          hostvars[ args[0] ] = args[1]
+        elif operation == 'add_group':
+          group( args[0] )
+        elif operation == 'del_group':
+          groups.pop( args[0], None )
+        elif operation == 'set_group_var':
+          group( args[0] )['vars'][ args[1] ] = args[2]
+        elif operation == 'del_group_var':
+          group( args[0] )['vars'].pop( args[1], None )
+        elif operation == 'set_group_vars':
+          group( args[0] )['vars'] = args[1]
+        elif operation == 'add_group_host':
+          group( args[0] )['hosts'][ args[1] ] = None
+        elif operation == 'del_group_host':
+          group( args[0] )['hosts'].pop( args[1], None )
+        elif operation == 'add_group_child':
+          group( args[0] )['children'][ args[1] ] = None
+        elif operation == 'del_group_child':
+          group( args[0] )['children'].pop( args[1], None )
+        elif operation == 'set_group_children':
+          group( args[0] )['children'] = dict.fromkeys( args[1] )
+        else:
+          raise AnsibleInventory_Exception( "Unknown delta operation: %s", operation )
+
+    for g in [ g for g in inventory if g != '_meta' and g not in groups ]:
+      inventory.pop( g )
+    for g, g_data in groups.items():
+      inventory[g] = { 'hosts': list( g_data['hosts'] ), 'vars': g_data['vars'], 'children': list( g_data['children'] ) }
+
+  def load_host_vars(self, host):
+    "Returns the vars of a single host from the host vars index, which is built again when the inventory changes"
+    version = self.get_version()
+    if version is None:
+      return {}
+    h_vars = self.__read_hostvars_index( version, host )
+    if h_vars is not None:
+      return h_vars
+    hostvars = self.load_inventory().get( '_meta', {} ).get( 'hostvars', {} )
+    self.__write_hostvars_index( version, hostvars )
+    return hostvars.get( host, {} )
+
+  def __read_hostvars_index(self, version, host):
+    "Returns the vars of host from the index if it was built for version, otherwise None"
+    import sqlite3
+    import urllib.parse
+    try:
+      db = sqlite3.connect( 'file:%s?mode=ro' % urllib.parse.quote( self.hostvars_path ), uri=True )
+    except sqlite3.Error:
+      return None
+    try:
+      if db.execute( 'SELECT version FROM meta' ).fetchone() != ( json.dumps( version ), ):
+        return None
+      row = db.execute( 'SELECT vars FROM host_vars WHERE host = ?', ( host, ) ).fetchone()
+      return json.loads( row[0] ) if row else {}
+    except sqlite3.Error:
+      return None
+    finally:
+      db.close()
+
+  def __write_hostvars_index(self, version, hostvars):
+    """Builds the host vars index for version: a sqlite database with the json encoded vars of each host. It is
+    built in a temporary file that replaces the old index, so readers always find a complete one"""
+    import sqlite3
+    import tempfile
+    try:
+      fd, tmp_path = tempfile.mkstemp( dir=os.path.dirname( self.hostvars_path ), suffix='.tmp' )
+      os.close( fd )
+    except OSError:
+      # The index is just an optimization
+      return
+    try:
+      db = sqlite3.connect( tmp_path, isolation_level=None )
+      try:
+        db.execute( 'PRAGMA journal_mode = OFF' )
+        db.execute( 'PRAGMA synchronous = OFF' )
+        db.execute( 'BEGIN' )
+        db.execute( 'CREATE TABLE meta ( version TEXT )' )
+        db.execute( 'CREATE TABLE host_vars ( host TEXT PRIMARY KEY, vars TEXT )' )
+        db.execute( 'INSERT INTO meta VALUES ( ? )', ( json.dumps( version ), ) )
+        db.executemany( 'INSERT INTO host_vars VALUES ( ?, ? )', ( ( h, json.dumps( v ) ) for h, v in hostvars.items() ) )
+        db.execute( 'COMMIT' )
+      finally:
+        db.close()
+      os.replace( tmp_path, self.hostvars_path )
+    except ( OSError, sqlite3.Error ):
+      try:
+        os.unlink( tmp_path )
+      except OSError:
+        pass
+
+  def get_version(self):
+    "Returns a token built from the inode, size and modification time of the inventory file (and of the journal)"
+    version = []
+    for path in ( self.json_path, self.journal_path ) if self.journal else ( self.json_path, ):
+      try:
+        st = os.stat( path )
+        version.append( ( st.st_ino, st.st_size, st.st_mtime_ns ) )
+      except FileNotFoundError:
+        version.append( None )
+    if version == [ None ] * len( version ):
+      return None
+    return tuple( version ) if self.journal else version[0]
 
   def save_inventory(self, inventory):
     "Saves the inventory from a dictionary with the inventory contents from the Inventory class"
     with SimpleFlock( self.lockfile, timeout=3 ):
-      with open( self.json_path, 'w' ) as inv_file:
-        if self.pretty:
-            inv_file.write( json.dumps( inventory, sort_keys=True, indent=4 ) )
-        else:
-            inv_file.write( json.dumps( inventory ) )
+      self.__write_inventory( inventory )
+
+  def __write_inventory(self, inventory):
+    "Replaces the inventory file. The journal, which is already applied in inventory, is moved to <journal>.old"
+    with atomic_open( self.json_path ) as inv_file:
+      if self.pretty:
+          json.dump( inventory, inv_file, sort_keys=True, indent=4 )
+      else:
+          for chunk in iterencode_json( inventory ):
+            inv_file.write( chunk )
+    # If this is interrupted before moving the journal, it is applied again on the next load,
+    # which gives the same inventory because applying the same operations twice has no effect
+    if self.journal and os.path.exists( self.journal_path ):
+      os.replace( self.journal_path, self.journal_path + '.old' )
+
+  def apply_delta(self, delta):
+    """Appends the delta operations to the journal as a single record, compacting it when it is too big. Records
+    are numbered, so the number of records in the journal is read from the last one"""
+    import getpass
+    try:
+      user = getpass.getuser()
+    except ( KeyError, OSError ):
+      # The uid has no passwd entry (i.e. in containers)
+      user = str( os.getuid() )
+    # The journal has var values, so it gets the permissions of the inventory file (also once moved to <journal>.old)
+    permissions = file_permissions( self.json_path, 0o600 )
+    with SimpleFlock( self.lockfile, timeout=3 ):
+      with open( self.journal_path, 'a+b', opener=lambda path, flags: os.open( path, flags, permissions ) ) as journal:
+        size = journal.seek( 0, os.SEEK_END )
+        records = self.__journal_records( journal, size ) + 1
+        record = json.dumps( {
+          'time': time.strftime( '%Y-%m-%dT%H:%M:%S%z' ),
+          'user': user,
+          'record': records,
+          'ops': delta
+        } ).encode("utf-8") + b'\n'
+        # Do not append to a record that was not completely written
+        if size > 0:
+          journal.seek( -1, os.SEEK_END )
+          if journal.read( 1 ) != b'\n':
+            record = b'\n' + record
+        journal.write( record )
+        journal.flush()
+        os.fsync( journal.fileno() )
+        size = journal.tell()
+      if size > self.journal_max_size or records > self.journal_max_records:
+        self.__write_inventory( self.__read_inventory() )
+
+  def __journal_records(self, journal, size):
+    """Returns the number of records in the journal (of size bytes), from the number of its last record. If it was
+    not completely written (or the journal has no numbers) the lines are counted instead"""
+    if size == 0:
+      return 0
+    # The last record is read backwards, from the newline that ends it
+    end = size - 1
+    journal.seek( end )
+    if journal.read( 1 ) == b'\n':
+      last = b''
+      while end > 0:
+        start = max( 0, end - 65536 )
+        journal.seek( start )
+        last = journal.read( end - start ) + last
+        end = start
+        if b'\n' in last:
+          last = last[ last.rindex( b'\n' ) + 1: ]
+          break
+      try:
+        return int( json.loads( last )['record'] )
+      except ( ValueError, KeyError, TypeError ):
+        pass
+    journal.seek( 0 )
+    return sum( chunk.count( b'\n' ) for chunk in iter( lambda: journal.read( 65536 ), b'' ) )
 
   def lock(self):
     "Locks the backend for reading and writting"
@@ -73,16 +468,80 @@ class AnsibleInventory_FileBackend( AnsibleInventory_Backend ):
 
 
 class AnsibleInventory_RedisBackend( AnsibleInventory_Backend ):
-  "Backend class for ansible-inventory that uses redis for storage"
+  """Backend class for ansible-inventory that uses redis for storage.
+  With layout = json the inventory is stored as a single json document. With layout = normalized every host and
+  group is stored in its own keys, so changes only write the keys they touch:
+    <inventory_name>:hosts                    set with the hosts that have an entry in hostvars
+    <inventory_name>:hostvars:<host>          hash with the host vars (json encoded values)
+    <inventory_name>:groups                   set with all the groups
+    <inventory_name>:group:<group>:hosts      set with the hosts of a group
+    <inventory_name>:group:<group>:children   set with the children of a group
+    <inventory_name>:group:<group>:vars       hash with the group vars (json encoded values)
+  Saves are done by a script that checks, in the same round-trip, that the version counter did not change since
+  it was read in lock(), so they fail with a conflict if someone else saved in the meantime. With concurrency =
+  optimistic that is all, and writers never wait for each other. With concurrency = lock writers also take a lease
+  lock that expires after lock_ttl seconds, which the save script releases.
+  Connections are taken from a pool shared by all the backends with the same connection parameters.
+  With cache = True the last loaded inventory is kept in a local file along with its version, so it is only
+  downloaded again when someone saves it. The version is the save counter plus an epoch id, which is created
+  with the first save, so a counter starting again after the keys are removed does not match old caches."""
+
+  # Times the normalized inventory is read again when it changes while it is being loaded
+  LOAD_RETRIES = 10
+
+  # Max number of arguments per command in the save script, as lua has a limited stack for unpack()
+  SCRIPT_CHUNK = 1000
+
+  # With layout = json, inventories bigger than UPLOAD_CHUNK characters are uploaded before saving them, in chunks
+  # of that size sent in pipelines of UPLOAD_PIPELINE commands. The upload expires after UPLOAD_TTL milliseconds
+  UPLOAD_CHUNK = 1048576
+  UPLOAD_PIPELINE = 8
+  UPLOAD_TTL = 60000
+
+  # KEYS: version counter, lease lock, epoch and optionally an upload (see __upload). ARGV: expected version counter
+  # ('' for any), lease owner ('' for none), the json encoded list of commands to run, an epoch id to use if there
+  # is none and the expected length of the upload. Returns the epoch and the new version counter, nil if the version
+  # counter was not the expected one or 0 if the upload does not have the expected length
+  SAVE_SCRIPT = """
+local version = redis.call('get', KEYS[1]) or '0'
+if ARGV[1] ~= '' and version ~= ARGV[1] then
+  return false
+end
+if KEYS[4] and redis.call('strlen', KEYS[4]) ~= tonumber(ARGV[5]) then
+  return 0
+end
+for _, command in ipairs(cjson.decode(ARGV[3])) do
+  redis.call(unpack(command))
+end
+if ARGV[2] ~= '' and redis.call('get', KEYS[2]) == ARGV[2] then
+  redis.call('del', KEYS[2])
+end
+redis.call('set', KEYS[3], ARGV[4], 'NX')
+return { redis.call('get', KEYS[3]), redis.call('incr', KEYS[1]) }
+"""
+
+  # Deletes the lease lock only if it is still ours, it may have expired and been taken by someone else
+  RELEASE_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+
+  __pools = {}
 
   def __init__( self, backend_parameters, config ):
+    import hashlib
     import redis
+    import uuid
 
     # Set default values
-    host = backend_parameters['host']
+    host = backend_parameters.get( 'host' )
     port = 6379
     inventory_name = 'ansible_inventory'
     password = None
+    layout = 'json'
+    concurrency = 'optimistic'
+    lock_ttl = 30
+    unix_socket = None
+    pool_size = 10
+    socket_keepalive = False
+    cache = True
 
     # Use configured parameters when available
     if 'port' in backend_parameters and backend_parameters['port']:
@@ -91,36 +550,644 @@ class AnsibleInventory_RedisBackend( AnsibleInventory_Backend ):
       password = backend_parameters['password']
     if 'inventory_name' in backend_parameters and backend_parameters['inventory_name']:
       inventory_name = backend_parameters['inventory_name']
+    if 'layout' in backend_parameters and backend_parameters['layout']:
+      layout = backend_parameters['layout'].lower()
+    if layout not in ( 'json', 'normalized' ):
+      raise AnsibleInventory_Exception( "Unknown redis layout: %s", layout )
+    if 'concurrency' in backend_parameters and backend_parameters['concurrency']:
+      concurrency = backend_parameters['concurrency'].lower()
+    if concurrency not in ( 'optimistic', 'lock' ):
+      raise AnsibleInventory_Exception( "Unknown redis concurrency mode: %s", concurrency )
+    if 'lock_ttl' in backend_parameters and backend_parameters['lock_ttl']:
+      lock_ttl = float( backend_parameters['lock_ttl'] )
+    if 'unix_socket' in backend_parameters and backend_parameters['unix_socket']:
+      unix_socket = os.path.expanduser( backend_parameters['unix_socket'] )
+    if 'pool_size' in backend_parameters and backend_parameters['pool_size']:
+      pool_size = int( backend_parameters['pool_size'] )
+    if 'socket_keepalive' in backend_parameters and backend_parameters['socket_keepalive']:
+      socket_keepalive = backend_parameters['socket_keepalive'].lower() in ("true", "1", "yes", "on")
+    if 'cache' in backend_parameters and backend_parameters['cache']:
+      cache = backend_parameters['cache'].lower() in ("true", "1", "yes", "on")
 
-    self.r = redis.Redis( host=host, port=port, password=password )
+    pool_key = ( host, port, password, unix_socket, pool_size, socket_keepalive )
+    if pool_key not in self.__pools:
+      if unix_socket:
+        self.__pools[pool_key] = redis.BlockingConnectionPool(
+          connection_class=redis.UnixDomainSocketConnection, path=unix_socket, password=password,
+          max_connections=pool_size
+        )
+      else:
+        self.__pools[pool_key] = redis.BlockingConnectionPool(
+          host=host, port=port, password=password, socket_keepalive=socket_keepalive,
+          max_connections=pool_size
+        )
+
+    self.r = redis.Redis( connection_pool=self.__pools[pool_key] )
     self.i = inventory_name
+    self.version_key = inventory_name + '_version'
+    self.epoch_key = inventory_name + '_epoch'
+    self.normalized = layout == 'normalized'
+    self.partial_saves = self.normalized
+    self.optimistic = concurrency == 'optimistic'
     self.uuid = str( uuid.uuid4() )
     self.__lock_name = inventory_name + '_redis_backend_lock'
+    self.__lock_ttl = int( lock_ttl * 1000 )  # milliseconds
     self.__timeout = 3  # seconds
+    self.__leased = False
+    self.__locked = False
+    self.__read_version = None
+    self.__prefetched_version = None
+    self.__loading_version = None
+    self.__save_script = self.r.register_script( self.SAVE_SCRIPT )
+    self.__release_script = self.r.register_script( self.RELEASE_SCRIPT )
+
+    self.cache_path = None
+    if cache:
+      # One cache file for each redis server, inventory and layout
+      server_id = repr( ( host, port, unix_socket, inventory_name, layout ) ).encode("utf-8")
+      self.cache_path = os.path.join(
+        config.config_home, 'cache', 'redis-%s.json' % hashlib.sha1( server_id ).hexdigest()[:16]
+      )
+      self.ansible_json_path = self.cache_path[:-len('.json')] + '.list'
+      # The cache has all the vars of the inventory, which may have secrets
+      self.ansible_json_permissions = 0o600
+
+  def __key( self, *parts ):
+    "Returns the key name for an entity of the normalized layout"
+    return ':'.join( ( self.i, ) + parts )
+
+  def __version_token( self, epoch, counter ):
+    "Returns the version for the epoch and version counter read from redis"
+    if counter is None:
+      return None
+    return ( epoch.decode("utf-8") if epoch is not None else None, int( counter ) )
 
   def load_inventory( self ):
     "Returns a dictionary with the inventory contents as required by Inventory class"
-    i = self.r.get( self.i )
-    if i:
-      return json.loads( i.decode("utf-8") )
+    # The version returned by the last get_version is the one the inventory is expected to have
+    version, self.__loading_version = self.__loading_version, None
+    if self.cache_path and version is not None and version[0] is not None:
+      inventory = self.__read_cache( version )
+      if inventory is not None:
+        return inventory
+
+    if self.normalized:
+      inventory, version = self.__load_normalized()
     else:
-      return {}
+      # Both keys are read in a MULTI, so the version is the one of the inventory
+      pipe = self.r.pipeline()
+      pipe.get( self.i )
+      pipe.get( self.epoch_key )
+      pipe.get( self.version_key )
+      i, epoch, counter = pipe.execute()
+      inventory = json.loads( i.decode("utf-8") ) if i else {}
+      version = self.__version_token( epoch, counter )
+
+    if self.cache_path and version is not None and version[0] is not None:
+      self.__write_cache( version, inventory )
+    return inventory
+
+  def open_ansible_json( self, version ):
+    "Like in the base class, but versions without epoch are not trusted, as their counter may start again"
+    if version is None or version[0] is None:
+      return None
+    return super().open_ansible_json( version )
+
+  def save_ansible_json( self, version, chunks ):
+    if version is None or version[0] is None:
+      version = None
+    return super().save_ansible_json( version, chunks )
+
+  def __read_cache( self, version ):
+    "Returns the cached inventory if it has the given version, otherwise None"
+    try:
+      with open( self.cache_path ) as cache_file:
+        if json.loads( cache_file.readline() ) != list( version ):
+          return None
+        return json.loads( cache_file.read() )
+    except ( OSError, ValueError ):
+      return None
+
+  def __write_cache( self, version, inventory ):
+    "Saves the inventory in the cache file: the first line is the version and the second one the inventory"
+    try:
+      os.makedirs( os.path.dirname( self.cache_path ), exist_ok=True )
+      # It has all the vars of the inventory, which may have secrets
+      with atomic_open( self.cache_path, permissions=0o600 ) as cache_file:
+        cache_file.write( json.dumps( list( version ) ) + '\n' )
+        for chunk in iterencode_json( inventory ):
+          cache_file.write( chunk )
+    except OSError:
+      # The cache is just an optimization
+      pass
+
+  def __load_normalized( self ):
+    "Reads the normalized inventory and its version with two pipelined round-trips. It is read again if a save happens in between"
+    import random
+    delay = 0.001
+    for _ in range( self.LOAD_RETRIES ):
+      pipe = self.r.pipeline( transaction=False )
+      pipe.get( self.version_key )
+      pipe.get( self.epoch_key )
+      pipe.smembers( self.__key( 'hosts' ) )
+      pipe.smembers( self.__key( 'groups' ) )
+      version, epoch, hosts, groups = pipe.execute()
+      hosts = sorted( h.decode("utf-8") for h in hosts )
+      groups = sorted( g.decode("utf-8") for g in groups )
+
+      # The second read is a MULTI, so hosts and groups are read atomically along with the version
+      pipe = self.r.pipeline()
+      for h in hosts:
+        pipe.hgetall( self.__key( 'hostvars', h ) )
+      for g in groups:
+        pipe.smembers( self.__key( 'group', g, 'hosts' ) )
+        pipe.smembers( self.__key( 'group', g, 'children' ) )
+        pipe.hgetall( self.__key( 'group', g, 'vars' ) )
+      pipe.get( self.version_key )
+      results = pipe.execute()
+      if results.pop() != version:
+        time.sleep( random.uniform( 0, delay ) )
+        delay = min( delay * 2, 0.1 )
+        continue
+
+      inventory = {}
+      g_results = results[ len( hosts ): ]
+      for n, g in enumerate( groups ):
+        g_hosts, g_children, g_vars = g_results[ 3*n : 3*n + 3 ]
+        inventory[g] = {
+          'hosts': sorted( h.decode("utf-8") for h in g_hosts ),
+          'children': sorted( c.decode("utf-8") for c in g_children ),
+          'vars': self.__decode_vars( g_vars )
+        }
+      if hosts or groups:
+        inventory['_meta'] = {
+          'hostvars': { h: self.__decode_vars( h_vars ) for h, h_vars in zip( hosts, results ) }
+        }
+      return inventory, self.__version_token( epoch, version )
+    raise BlockingIOError( "The inventory changed too many times while loading it" )
+
+  def load_host_vars( self, host ):
+    "Returns the vars of a single host. With layout = normalized they are read with a single HGETALL"
+    if not self.normalized:
+      return super().load_host_vars( host )
+    return self.__decode_vars( self.r.hgetall( self.__key( 'hostvars', host ) ) )
+
+  def __decode_vars( self, raw_vars ):
+    "Decodes a vars hash"
+    return { k.decode("utf-8"): json.loads( v.decode("utf-8") ) for k, v in raw_vars.items() }
+
+  def __add_command( self, commands, command, key, args ):
+    "Appends a command to the list for the save script, split in several commands if it has too many arguments"
+    for n in range( 0, len( args ), self.SCRIPT_CHUNK ):
+      commands.append( [ command, key ] + args[ n : n + self.SCRIPT_CHUNK ] )
+
+  def __write_host( self, commands, host, h_vars ):
+    "Adds the commands to write a host vars. h_vars is None when the host is removed"
+    key = self.__key( 'hostvars', host )
+    commands.append( [ 'DEL', key ] )
+    if h_vars is None:
+      commands.append( [ 'SREM', self.__key( 'hosts' ), host ] )
+      return
+    commands.append( [ 'SADD', self.__key( 'hosts' ), host ] )
+    self.__write_vars( commands, key, h_vars )
+
+  def __write_group( self, commands, group, g_data ):
+    "Adds the commands to write a group. g_data is None when the group is removed"
+    keys = { part: self.__key( 'group', group, part ) for part in ( 'hosts', 'children', 'vars' ) }
+    commands.append( [ 'DEL' ] + list( keys.values() ) )
+    if g_data is None:
+      commands.append( [ 'SREM', self.__key( 'groups' ), group ] )
+      return
+    commands.append( [ 'SADD', self.__key( 'groups' ), group ] )
+    if isinstance( g_data, list ):
+      g_data = { 'hosts': g_data }
+    for part in ( 'hosts', 'children' ):
+      self.__add_command( commands, 'SADD', keys[part], list( g_data.get( part ) or () ) )
+    self.__write_vars( commands, keys['vars'], g_data.get( 'vars' ) or {} )
+
+  def __write_vars( self, commands, key, w_vars ):
+    "Adds the commands to write a vars hash (json encoded values)"
+    args = []
+    for k, v in w_vars.items():
+      args += [ k, json.dumps( v ) ]
+    self.__add_command( commands, 'HSET', key, args )
+
+  def __commit( self, commands, upload=None ):
+    """Runs the commands, increases the version and releases the lease lock in a single round-trip. upload is the
+    key and length of an upload used by the commands, which are only run if it is complete. Returns the new version"""
+    import uuid
+    expected = ''
+    if self.__locked:
+      expected = str( self.__read_version[1] if self.__read_version else 0 )
+    keys = [ self.version_key, self.__lock_name, self.epoch_key ]
+    args = [ expected, self.uuid if self.__leased else '', json.dumps( commands ), str( uuid.uuid4() ) ]
+    if upload is not None:
+      keys.append( upload[0] )
+      args.append( str( upload[1] ) )
+    result = self.__save_script( keys=keys, args=args )
+    if result is None:
+      raise AnsibleInventory_ConflictException( "The inventory was changed by someone else. Please try again." )
+    if result == 0:
+      raise AnsibleInventory_Exception( "The upload of the inventory to redis expired. Please try again." )
+    version = self.__version_token( *result )
+    self.__leased = False
+    self.__read_version = version
+    return version
 
   def save_inventory(self, inventory):
     "Saves the inventory from a dictionary with the inventory contents from the Inventory class"
-    self.r.set( self.i, json.dumps( inventory ) )
+    commands = []
+    if self.normalized:
+      # Anything added after this read makes the version check fail
+      pipe = self.r.pipeline( transaction=False )
+      pipe.smembers( self.__key( 'hosts' ) )
+      pipe.smembers( self.__key( 'groups' ) )
+      old_hosts, old_groups = pipe.execute()
+      for h in old_hosts:
+        commands.append( [ 'DEL', self.__key( 'hostvars', h.decode("utf-8") ) ] )
+      for g in old_groups:
+        commands.append( [ 'DEL' ] + [ self.__key( 'group', g.decode("utf-8"), part ) for part in ( 'hosts', 'children', 'vars' ) ] )
+      commands.append( [ 'DEL', self.__key( 'hosts' ), self.__key( 'groups' ) ] )
+      for h, h_vars in inventory.get( '_meta', {} ).get( 'hostvars', {} ).items():
+        self.__write_host( commands, h, h_vars )
+      for g, g_data in inventory.items():
+        if g != '_meta':
+          self.__write_group( commands, g, g_data )
+    else:
+      chunks = iterencode_json( inventory, chunk_size=self.UPLOAD_CHUNK )
+      first = next( chunks )
+      second = next( chunks, None )
+      if second is None:
+        commands.append( [ 'SET', self.i, first ] )
+      else:
+        # Big inventories are uploaded in chunks to a temporary key, which the save script renames
+        upload = self.__upload( itertools.chain( ( first, second ), chunks ) )
+        commands.append( [ 'RENAME', upload[0], self.i ] )
+        commands.append( [ 'PERSIST', self.i ] )
+        try:
+          return self.__commit( commands, upload=upload )
+        except AnsibleInventory_Exception:
+          self.r.delete( upload[0] )
+          raise
+    return self.__commit( commands )
+
+  def __upload( self, chunks ):
+    """Appends the chunks to a temporary key, sending a few of them in each round-trip, so the whole json document
+    is never in memory. The key expires in case the save does not happen, UPLOAD_TTL milliseconds after the last
+    round-trip. Returns the key name and the length of the upload, which is checked before using it, as the key
+    may have expired in the middle of the upload"""
+    key = '%s:upload:%s' % ( self.i, self.uuid )
+    length = 0
+    pipe = self.r.pipeline( transaction=False )
+    pipe.delete( key )
+    for chunk in chunks:
+      chunk = chunk.encode("utf-8")
+      length += len( chunk )
+      pipe.append( key, chunk )
+      if len( pipe ) >= self.UPLOAD_PIPELINE:
+        pipe.pexpire( key, self.UPLOAD_TTL )
+        pipe.execute()
+    pipe.pexpire( key, self.UPLOAD_TTL )
+    pipe.execute()
+    return key, length
+
+  def apply_delta(self, delta):
+    "Saves the delta operations in a single transaction (normalized layout)"
+    commands = []
+    for operation, *args in delta:
+      if operation == 'add_host':
+        commands.append( [ 'SADD', self.__key( 'hosts' ), args[0] ] )
+      elif operation == 'del_host':
+        self.__write_host( commands, args[0], None )
+      elif operation == 'set_host_var':
+        commands.append( [ 'SADD', self.__key( 'hosts' ), args[0] ] )
+        commands.append( [ 'HSET', self.__key( 'hostvars', args[0] ), args[1], json.dumps( args[2] ) ] )
+      elif operation == 'del_host_var':
+        commands.append( [ 'HDEL', self.__key( 'hostvars', args[0] ), args[1] ] )
+      elif operation == 'set_host_vars':
+        self.__write_host( commands, args[0], args[1] )
+      elif operation == 'add_group':
+        commands.append( [ 'SADD', self.__key( 'groups' ), args[0] ] )
+      elif operation == 'del_group':
+        self.__write_group( commands, args[0], None )
+      elif operation == 'set_group_var':
+        commands.append( [ 'HSET', self.__key( 'group', args[0], 'vars' ), args[1], json.dumps( args[2] ) ] )
+      elif operation == 'del_group_var':
+        commands.append( [ 'HDEL', self.__key( 'group', args[0], 'vars' ), args[1] ] )
+      elif operation == 'set_group_vars':
+        commands.append( [ 'DEL', self.__key( 'group', args[0], 'vars' ) ] )
+        self.__write_vars( commands, self.__key( 'group', args[0], 'vars' ), args[1] )
+      elif operation == 'add_group_host':
+        # The group is added too, as the hosts of the groups that are not in the groups set are not loaded
+        commands.append( [ 'SADD', self.__key( 'groups' ), args[0] ] )
+        commands.append( [ 'SADD', self.__key( 'group', args[0], 'hosts' ), args[1] ] )
+      elif operation == 'del_group_host':
+        commands.append( [ 'SREM', self.__key( 'group', args[0], 'hosts' ), args[1] ] )
+      elif operation == 'add_group_child':
+        commands.append( [ 'SADD', self.__key( 'group', args[0], 'children' ), args[1] ] )
+      elif operation == 'del_group_child':
+        commands.append( [ 'SREM', self.__key( 'group', args[0], 'children' ), args[1] ] )
+      elif operation == 'set_group_children':
+        commands.append( [ 'DEL', self.__key( 'group', args[0], 'children' ) ] )
+        self.__add_command( commands, 'SADD', self.__key( 'group', args[0], 'children' ), list( args[1] ) )
+      else:
+        raise AnsibleInventory_Exception( "Unknown delta operation: %s", operation )
+    return self.__commit( commands )
+
+  def get_version(self):
+    "Returns the inventory generation counter, which is increased on every save"
+    if self.__prefetched_version is not None:
+      version, = self.__prefetched_version
+      self.__prefetched_version = None
+    else:
+      version = self.__version_token( *self.r.mget( self.epoch_key, self.version_key ) )
+    self.__loading_version = version
+    if self.__locked:
+      # Saves will check that nobody changed it
+      self.__read_version = version
+    return version
 
   def lock(self):
-    "Locks the backend for reading and writting"
-    # Try to get the lock or raise exception on timeout
-    t=0
-    while not self.r.set( self.__lock_name, self.uuid, nx=True ):
-      if t >= self.__timeout:
+    "Starts a transaction: saves will fail if someone else saves first. In lock mode it also takes the lease lock"
+    self.__locked = True
+    self.__read_version = None
+    if not self.optimistic:
+      self.__acquire_lease()
+
+  def __acquire_lease(self):
+    "Takes the lock with an expiration, polling with exponential backoff and full jitter. Raises BlockingIOError on timeout"
+    import random
+    deadline = time.monotonic() + self.__timeout
+    delay = 0.001
+    while True:
+      # The version is read along with the lock, so the reload that follows costs no round-trip
+      pipe = self.r.pipeline( transaction=False )
+      pipe.set( self.__lock_name, self.uuid, nx=True, px=self.__lock_ttl )
+      pipe.mget( self.epoch_key, self.version_key )
+      acquired, version = pipe.execute()
+      if acquired:
+        break
+      remaining = deadline - time.monotonic()
+      if remaining <= 0:
         raise BlockingIOError
-      time.sleep( 0.5 )
-      t+=0.5
+      time.sleep( min( remaining, random.uniform( 0, delay ) ) )
+      delay = min( delay * 2, 0.1 )
+    self.__leased = True
+    self.__prefetched_version = ( self.__version_token( *version ), )
 
   def unlock(self):
-    "Unlocks the backend"
-    if self.r.get( self.__lock_name ).decode("ascii") == self.uuid:
-      self.r.delete( self.__lock_name )
+    "Ends the transaction and releases the lease lock if it is still held"
+    self.__locked = False
+    self.__prefetched_version = None
+    if self.__leased:
+      self.__leased = False
+      self.__release_script( keys=[ self.__lock_name ], args=[ self.uuid ] )
+
+
+class AnsibleInventory_SqliteBackend( AnsibleInventory_Backend ):
+  """Backend class for ansible-inventory that uses a sqlite database in WAL mode for storage, so readers never block
+  the writer. Hosts, groups, group members, group children and vars have their own indexed tables (vars values are
+  json encoded), so saving a change only writes the rows it touches (see apply_delta) and the vars of a host
+  are read with a single query. Rows are read in insertion order, so the inventory keeps its order."""
+
+  partial_saves = True
+
+  # The epoch identifies the database, so a new database does not match the versions of an old one
+  SCHEMA = """
+BEGIN IMMEDIATE;
+CREATE TABLE IF NOT EXISTS meta ( key TEXT PRIMARY KEY, value );
+CREATE TABLE IF NOT EXISTS hosts ( name TEXT PRIMARY KEY );
+CREATE TABLE IF NOT EXISTS host_vars ( host TEXT, name TEXT, value TEXT, PRIMARY KEY ( host, name ) );
+CREATE TABLE IF NOT EXISTS inventory_groups ( name TEXT PRIMARY KEY );
+CREATE TABLE IF NOT EXISTS group_vars ( grp TEXT, name TEXT, value TEXT, PRIMARY KEY ( grp, name ) );
+CREATE TABLE IF NOT EXISTS group_hosts ( grp TEXT, host TEXT, PRIMARY KEY ( grp, host ) );
+CREATE TABLE IF NOT EXISTS group_children ( grp TEXT, child TEXT, PRIMARY KEY ( grp, child ) );
+CREATE INDEX IF NOT EXISTS group_hosts_host ON group_hosts ( host );
+CREATE INDEX IF NOT EXISTS group_children_child ON group_children ( child );
+INSERT OR IGNORE INTO meta VALUES ( 'version', 0 );
+INSERT OR IGNORE INTO meta VALUES ( 'epoch', lower( hex( randomblob( 16 ) ) ) );
+COMMIT;
+"""
+
+  # Sets a var keeping its position if it already exists. Takes the table and its owner column, as the conflict
+  # target is required by sqlite before 3.35
+  UPSERT_VAR = 'INSERT INTO %s VALUES ( ?, ?, ? ) ON CONFLICT ( %s, name ) DO UPDATE SET value = excluded.value'
+
+  def __init__( self, backend_parameters, config ):
+    import sqlite3
+
+    self.db_path = os.path.expanduser(
+      backend_parameters['path'].strip('"\'')
+    )
+    if not os.path.isabs( self.db_path ):
+      self.db_path = os.path.join( config.config_home, self.db_path )
+    self.ansible_json_path = os.path.join( os.path.dirname( self.db_path ), '.' + os.path.basename( self.db_path ) + '.list' )
+
+    self.__locked_error = sqlite3.OperationalError
+    # The connection may be used from another thread (i.e. the writer of the daemon), but never by two at once
+    self.db = sqlite3.connect( self.db_path, timeout=3, isolation_level=None, check_same_thread=False )
+    self.db.execute( 'PRAGMA journal_mode = WAL' )
+    self.db.execute( 'PRAGMA synchronous = NORMAL' )
+    if not self.db.execute( "SELECT 1 FROM sqlite_master WHERE name = 'meta'" ).fetchone():
+      try:
+        self.db.executescript( self.SCHEMA )
+      except self.__locked_error as e:
+        raise AnsibleInventory_Exception( "Cannot create the inventory database: %s" % e )
+
+  @property
+  def ansible_json_permissions(self):
+    "The ansible json gets the permissions of the database file"
+    return file_permissions( self.db_path, 0o600 )
+
+  @contextmanager
+  def __read(self):
+    "Runs the block in a read transaction, so all the queries see the same snapshot"
+    if self.db.in_transaction:
+      yield
+      return
+    self.db.execute( 'BEGIN' )
+    try:
+      yield
+    finally:
+      self.db.execute( 'COMMIT' )
+
+  @contextmanager
+  def __write(self):
+    "Runs the block in a write transaction, which is commited when it ends. Between lock() and unlock() it is the one opened by lock()"
+    if not self.db.in_transaction:
+      self.__begin()
+    try:
+      yield
+    except BaseException:
+      self.db.execute( 'ROLLBACK' )
+      raise
+    self.db.execute( 'COMMIT' )
+
+  def __begin(self):
+    "Starts a write transaction, waiting for the current writer. Raises BlockingIOError on timeout"
+    try:
+      self.db.execute( 'BEGIN IMMEDIATE' )
+    except self.__locked_error as e:
+      raise BlockingIOError( str( e ) )
+
+  def load_inventory(self):
+    "Returns a dictionary with the inventory contents as required by Inventory class"
+    with self.__read():
+      hostvars = { h: {} for ( h, ) in self.db.execute( 'SELECT name FROM hosts ORDER BY rowid' ) }
+      for h, name, value in self.db.execute( 'SELECT host, name, value FROM host_vars ORDER BY rowid' ):
+        hostvars.setdefault( h, {} )[name] = json.loads( value )
+
+      # Rows of a group that is not in inventory_groups still belong to it
+      inventory = {}
+      def group(name):
+        return inventory.setdefault( name, { 'hosts': [], 'vars': {}, 'children': [] } )
+
+      for ( g, ) in self.db.execute( 'SELECT name FROM inventory_groups ORDER BY rowid' ):
+        group( g )
+      for g, h in self.db.execute( 'SELECT grp, host FROM group_hosts ORDER BY rowid' ):
+        group( g )['hosts'].append( h )
+      for g, c in self.db.execute( 'SELECT grp, child FROM group_children ORDER BY rowid' ):
+        group( g )['children'].append( c )
+      for g, name, value in self.db.execute( 'SELECT grp, name, value FROM group_vars ORDER BY rowid' ):
+        group( g )['vars'][name] = json.loads( value )
+
+    if inventory or hostvars:
+      inventory['_meta'] = { 'hostvars': hostvars }
+    return inventory
+
+  def load_host_vars(self, host):
+    "Returns the vars of a single host"
+    rows = self.db.execute( 'SELECT name, value FROM host_vars WHERE host = ? ORDER BY rowid', ( host, ) )
+    return { name: json.loads( value ) for name, value in rows }
+
+  def __keeps_order(self, current, new):
+    "Returns True if new can be written as current plus some deletions and some appended items, keeping its order"
+    kept = [ item for item in current if item in new ]
+    return list( new ) == kept + [ item for item in new if item not in current ]
+
+  def __sync_vars(self, table, owner_column, owner, new_vars):
+    "Updates the vars rows of a host or group, only writing the vars that changed"
+    query = 'SELECT name, value FROM %s WHERE %s = ? ORDER BY rowid' % ( table, owner_column )
+    current = dict( self.db.execute( query, ( owner, ) ) )
+    encoded = { name: json.dumps( value ) for name, value in new_vars.items() }
+    if not self.__keeps_order( current, encoded ):
+      self.db.execute( 'DELETE FROM %s WHERE %s = ?' % ( table, owner_column ), ( owner, ) )
+      current = {}
+    self.db.executemany(
+      'DELETE FROM %s WHERE %s = ? AND name = ?' % ( table, owner_column ),
+      [ ( owner, name ) for name in current if name not in encoded ]
+    )
+    self.db.executemany(
+      self.UPSERT_VAR % ( table, owner_column ),
+      [ ( owner, name, value ) for name, value in encoded.items() if current.get( name ) != value ]
+    )
+
+  def __sync_members(self, table, member_column, group, members):
+    "Updates the hosts or children rows of a group, only writing the members that changed"
+    query = 'SELECT %s FROM %s WHERE grp = ? ORDER BY rowid' % ( member_column, table )
+    current = { m: None for ( m, ) in self.db.execute( query, ( group, ) ) }
+    if not self.__keeps_order( current, members ):
+      self.db.execute( 'DELETE FROM %s WHERE grp = ?' % table, ( group, ) )
+      current = {}
+    self.db.executemany(
+      'DELETE FROM %s WHERE grp = ? AND %s = ?' % ( table, member_column ),
+      [ ( group, m ) for m in current if m not in members ]
+    )
+    self.db.executemany(
+      'INSERT INTO %s VALUES ( ?, ? )' % table,
+      [ ( group, m ) for m in members if m not in current ]
+    )
+
+  def __write_host(self, host, h_vars):
+    "Writes the vars of a host. h_vars is None when the host is removed"
+    if h_vars is None:
+      self.db.execute( 'DELETE FROM hosts WHERE name = ?', ( host, ) )
+      self.db.execute( 'DELETE FROM host_vars WHERE host = ?', ( host, ) )
+      return
+    self.db.execute( 'INSERT OR IGNORE INTO hosts VALUES ( ? )', ( host, ) )
+    self.__sync_vars( 'host_vars', 'host', host, h_vars )
+
+  def __write_group(self, group, g_data):
+    "Writes a group. g_data is None when the group is removed"
+    if g_data is None:
+      self.db.execute( 'DELETE FROM inventory_groups WHERE name = ?', ( group, ) )
+      for table in ( 'group_vars', 'group_hosts', 'group_children' ):
+        self.db.execute( 'DELETE FROM %s WHERE grp = ?' % table, ( group, ) )
+      return
+    if isinstance( g_data, list ):
+      g_data = { 'hosts': g_data }
+    self.db.execute( 'INSERT OR IGNORE INTO inventory_groups VALUES ( ? )', ( group, ) )
+    self.__sync_members( 'group_hosts', 'host', group, dict.fromkeys( g_data.get( 'hosts' ) or () ) )
+    self.__sync_members( 'group_children', 'child', group, dict.fromkeys( g_data.get( 'children' ) or () ) )
+    self.__sync_vars( 'group_vars', 'grp', group, g_data.get( 'vars' ) or {} )
+
+  def __increase_version(self):
+    "Increases the version counter and returns the new version"
+    self.db.execute( "UPDATE meta SET value = value + 1 WHERE key = 'version'" )
+    return self.get_version()
+
+  def save_inventory(self, inventory):
+    "Saves the inventory from a dictionary with the inventory contents from the Inventory class"
+    with self.__write():
+      for table in ( 'hosts', 'host_vars', 'inventory_groups', 'group_vars', 'group_hosts', 'group_children' ):
+        self.db.execute( 'DELETE FROM %s' % table )
+      for h, h_vars in inventory.get( '_meta', {} ).get( 'hostvars', {} ).items():
+        self.__write_host( h, h_vars )
+      for g, g_data in inventory.items():
+        if g != '_meta':
+          self.__write_group( g, g_data )
+      return self.__increase_version()
+
+  def apply_delta(self, delta):
+    "Saves the delta operations in a single transaction"
+    with self.__write():
+      for operation, *args in delta:
+        if operation == 'add_host':
+          self.db.execute( 'INSERT OR IGNORE INTO hosts VALUES ( ? )', args )
+        elif operation == 'del_host':
+          self.__write_host( args[0], None )
+        elif operation == 'set_host_var':
+          self.db.execute( 'INSERT OR IGNORE INTO hosts VALUES ( ? )', args[:1] )
+          self.db.execute( self.UPSERT_VAR % ( 'host_vars', 'host' ), ( args[0], args[1], json.dumps( args[2] ) ) )
+        elif operation == 'del_host_var':
+          self.db.execute( 'DELETE FROM host_vars WHERE host = ? AND name = ?', args )
+        elif operation == 'set_host_vars':
+          self.__write_host( args[0], args[1] )
+        elif operation == 'add_group':
+          self.db.execute( 'INSERT OR IGNORE INTO inventory_groups VALUES ( ? )', args )
+        elif operation == 'del_group':
+          self.__write_group( args[0], None )
+        elif operation == 'set_group_var':
+          self.db.execute( self.UPSERT_VAR % ( 'group_vars', 'grp' ), ( args[0], args[1], json.dumps( args[2] ) ) )
+        elif operation == 'del_group_var':
+          self.db.execute( 'DELETE FROM group_vars WHERE grp = ? AND name = ?', args )
+        elif operation == 'set_group_vars':
+          self.__sync_vars( 'group_vars', 'grp', args[0], args[1] )
+        elif operation == 'add_group_host':
+          self.db.execute( 'INSERT OR IGNORE INTO inventory_groups VALUES ( ? )', args[:1] )
+          self.db.execute( 'INSERT OR IGNORE INTO group_hosts VALUES ( ?, ? )', args )
+        elif operation == 'del_group_host':
+          self.db.execute( 'DELETE FROM group_hosts WHERE grp = ? AND host = ?', args )
+        elif operation == 'add_group_child':
+          self.db.execute( 'INSERT OR IGNORE INTO group_children VALUES ( ?, ? )', args )
+        elif operation == 'del_group_child':
+          self.db.execute( 'DELETE FROM group_children WHERE grp = ? AND child = ?', args )
+        elif operation == 'set_group_children':
+          self.__sync_members( 'group_children', 'child', args[0], dict.fromkeys( args[1] ) )
+        else:
+          raise AnsibleInventory_Exception( "Unknown delta operation: %s", operation )
+      return self.__increase_version()
+
+  def get_version(self):
+    "Returns the database epoch and version counter, which is increased on every save"
+    meta = dict( self.db.execute( "SELECT key, value FROM meta WHERE key IN ( 'epoch', 'version' )" ) )
+    return ( meta.get( 'epoch' ), meta.get( 'version' ) )
+
+  def lock(self):
+    "Starts the write transaction, so other writers wait until unlock()"
+    self.__begin()
+
+  def unlock(self):
+    "Ends the write transaction. It was already commited if the inventory was saved"
+    if self.db.in_transaction:
+      self.db.execute( 'ROLLBACK' )
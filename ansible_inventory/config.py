@@ -2,9 +2,8 @@
 # vim: set ts=2 sw=2 sts=2 et:
 
 import configparser
+import importlib
 import os
-import readline
-from ansible_inventory.backends import AnsibleInventory_FileBackend, AnsibleInventory_RedisBackend
 from ansible_inventory.lib import AnsibleInventory_Exception
 
 
@@ -13,25 +12,44 @@ class AnsibleInventory_Config:
 
   default_config = """[global]
   use_colors = True
+  # unix socket of the daemon (ansible-inv --daemon), relative to this directory
+  daemon_socket = ansible-inventory.sock
 
-  # backend: redis, file
+  # backend: redis, file, sqlite
   backend = file
 
 
   [file_backend]
   path = ~/.ansible/inventory.json
   pretty = False
+  journal = False
+  journal_max_size = 1048576
+  journal_max_records = 1000
+
+  [sqlite_backend]
+  path = ~/.ansible/inventory.sqlite
 
   [redis_backend]
   host =
   port =
   password =
   inventory_name = ansible_inventory
+  # layout: json, normalized
+  layout = json
+  # concurrency: optimistic, lock
+  concurrency = optimistic
+  lock_ttl = 30
+  unix_socket =
+  pool_size = 10
+  socket_keepalive = False
+  cache = True
   """
 
+  # Backend classes by name. Their module is only imported when the backend is used
   available_backends = {
-    'file': AnsibleInventory_FileBackend,
-    'redis': AnsibleInventory_RedisBackend
+    'file': 'ansible_inventory.backends.AnsibleInventory_FileBackend',
+    'redis': 'ansible_inventory.backends.AnsibleInventory_RedisBackend',
+    'sqlite': 'ansible_inventory.backends.AnsibleInventory_SqliteBackend'
   }
 
   def __init__( self, ai_exec_file ):
@@ -56,21 +74,34 @@ class AnsibleInventory_Config:
 
     # option declarations (for clarity)
     self.use_colors = True
+    self.daemon_socket = None
     self.backend = {
-      'class': AnsibleInventory_FileBackend,
+      'name': None,
       'parameters': {}
     }
 
     # Parse configuration
     self.use_colors = self.__config['global'].getboolean('use_colors')
+    self.daemon_socket = os.path.join(
+      self.config_home, os.path.expanduser( self.__config['global'].get( 'daemon_socket', 'ansible-inventory.sock' ) )
+    )
 
     backend_id = self.__config['global']['backend'].lower()
     if backend_id in self.available_backends:
-      self.backend['class'] = self.available_backends[backend_id]
+      self.backend['name'] = backend_id
       self.backend['parameters'] = self.__config[backend_id+'_backend']
     else:
       raise AnsibleInventory_Exception( "No valid backend found" )
 
+  def get_backend_class( self, backend_id ):
+    'Returns the class of a backend by its name, importing its module'
+    module_name, class_name = self.available_backends[ backend_id ].rsplit( '.', 1 )
+    return getattr( importlib.import_module( module_name ), class_name )
+
+  def new_backend( self ):
+    'Returns an instance of the configured backend'
+    return self.get_backend_class( self.backend['name'] )( self.backend['parameters'], self )
+
   def __check_requirements( self ):
     if not os.path.exists( self.config_home ):
       os.mkdir( self.config_home )
@@ -79,9 +110,4 @@ class AnsibleInventory_Config:
       with open( self.config_file, 'w' ) as cf:
         cf.write( self.default_config )
         cf.close()
-
-    if not os.path.exists( self.history_file ):
-      open( self.history_file, 'a' ).close()
-    readline.read_history_file( self.history_file )
-    readline.set_completer_delims(' ')
 # )
@@ -0,0 +1,367 @@
+# -*- coding:utf-8 -*-
+# vim: set ts=2 sw=2 sts=2 et:
+
+# The client is used by ansible-inv for every ansible request, so signal, asyncio and the console are imported by
+# the daemon
+import json
+import os
+import socket
+import sys
+from ansible_inventory.lib import AnsibleInventory_Exception, AnsibleInventory_ConflictException
+
+
+### Protocol
+# The client sends a single json line with the request and the daemon answers with a sequence of frames:
+#   out <length>\n<length bytes>    Bytes to write to the standard output of the client
+#   exit <status>\n                 Last frame, with the exit status for the client
+# Requests:
+#   { "command": "list" }                          The ansible json (as ansible-inv --list)
+#   { "command": "host", "host": <host> }          The vars of a host (as ansible-inv --host)
+#   { "command": "console", "line": <line> }       Runs a console command (as ansible-inv --batch)
+#   { "command": "batch", "lines": [ <line> ] }    Runs several console commands (as ansible-inv --batch-file)
+# Console commands that open an editor (edit vars) are not run by the daemon, as it has no terminal and it would
+# stop the writer until the editor is closed. ansible-inv runs them itself (see is_interactive).
+
+
+def is_interactive( request ):
+  'Returns True if a console or batch request has a command that opens an editor'
+  for line in request.get( 'lines' ) or [ request.get( 'line' ) or '' ]:
+    if [ word for word in line.split() if '=' not in word ][:2] == [ 'edit', 'vars' ]:
+      return True
+  return False
+
+
+class AnsibleInventory_DaemonOutput:
+  'File like object that keeps the output of a request, which is sent to the client once the request is done'
+
+  CHUNK = 65536
+
+  def __init__(self):
+    self.chunks = []
+
+  def write(self, data):
+    if isinstance( data, str ):
+      data = data.encode("utf-8")
+    if data:
+      self.chunks.append( data )
+    return len( data )
+
+  def flush(self):
+    pass
+
+  async def send(self, writer, status):
+    'Sends the output in "out" frames of up to CHUNK bytes and the exit status'
+    for data in self.chunks:
+      data = memoryview( data )
+      for start in range( 0, len( data ), self.CHUNK ):
+        chunk = data[ start:start + self.CHUNK ]
+        writer.write( b'out %d\n' % len( chunk ) )
+        writer.write( chunk )
+        await writer.drain()
+    writer.write( b'exit %d\n' % status )
+    await writer.drain()
+
+
+class AnsibleInventory_DaemonStdout:
+  """Replaces sys.stdout in the daemon, writing to the output of the request being run in the current thread or
+  task (see AnsibleInventory_Daemon.output), so the console of the writer and the one of the readers do not mix"""
+
+  def __init__(self, stdout, output):
+    self.stdout = stdout
+    self.output = output
+
+  def write(self, data):
+    return self.output.get( self.stdout ).write( data )
+
+  def flush(self):
+    self.output.get( self.stdout ).flush()
+
+
+class AnsibleInventory_Daemon:
+  """Keeps an inventory loaded in memory and answers the requests of ansible-inv clients through a unix socket.
+  Reads (--list, --host and the show commands) are answered right away from a snapshot of the last saved
+  inventory, so they never wait for a write. Changes are queued and run by a single writer, which runs all the
+  queued ones in a single transaction, so a burst of changes is saved only once, and then takes a new snapshot.
+  The backend is still locked while saving, so ansible-inv instances that do not use the daemon can be run at the
+  same time, and the snapshot is taken again when someone else changes the inventory."""
+
+  # Console commands that only read the inventory
+  READ_COMMANDS = ( 'show', 'help' )
+
+  # Maximum number of queued changes saved at once
+  MAX_BATCH = 100
+
+  # Maximum size of a request line
+  REQUEST_LIMIT = 64 * 1048576
+
+  # Reads check if someone else changed the inventory at most once in this number of seconds
+  VERSION_CHECK_INTERVAL = 0.1
+
+  def __init__(self, inventory, config):
+    import contextvars
+    from concurrent.futures import ThreadPoolExecutor
+    from ansible_inventory.frontends import AnsibleInventory_Console
+
+    self.inventory = inventory
+    self.socket_path = config.daemon_socket
+    # Another backend to check the version of the inventory while the writer uses the one of the inventory
+    self.versions = config.new_backend()
+    # The writer thread is the only one that uses the inventory
+    self.executor = ThreadPoolExecutor( max_workers=1 )
+    # Output of the request being run (see AnsibleInventory_DaemonStdout)
+    self.output = contextvars.ContextVar( 'output' )
+    config.use_colors = False
+    self.writer = AnsibleInventory_Console( inventory, config )
+    # Its inventory is replaced with every new snapshot
+    self.reader = AnsibleInventory_Console( None, config )
+    self.snapshot = None
+    # The version check in progress, if any, and when the last one finished (see __check_version)
+    self.version_check = None
+    self.version_checked = None
+
+  def __take_snapshot(self):
+    'Run by the writer. Returns the version, the ansible json and a read only inventory of the saved inventory'
+    snapshot = self.inventory.snapshot()
+    # The json stored for its version, if any, or it is encoded and stored now
+    data = snapshot.get_ansible_json_bytes()[1]
+    return snapshot.backend.source_version, data, snapshot
+
+  def __install(self, snapshot):
+    'Makes the readers use a new snapshot'
+    self.snapshot = snapshot
+    self.reader.inventory = snapshot[2]
+
+  def __run_write(self, request):
+    'Run by the writer. Runs a change and returns its output and exit status'
+    output = AnsibleInventory_DaemonOutput()
+    token = self.output.set( output )
+    try:
+      if request['command'] == 'batch':
+        status = 1 if self.writer.batch( request['lines'] ) else 0
+      else:
+        self.writer.onecmd( request['line'], skip_confirm=True )
+        status = 0
+    except Exception:
+      raise
+    except BaseException as e:
+      # i.e. SystemExit, which would stop the daemon. The transaction is not saved
+      raise AnsibleInventory_Exception( 'The command was stopped (%s)' % type( e ).__name__ )
+    finally:
+      self.output.reset( token )
+    return output.chunks, status
+
+  def __write(self, requests):
+    'Run by the writer. Runs the changes in a single transaction and returns the output and exit status of each one'
+    try:
+      # If someone else saved the inventory they are run again over the new one
+      return self.inventory.run_transaction( lambda: [ self.__run_write( request ) for request in requests ] )
+    except AnsibleInventory_ConflictException as e:
+      error = e
+    except Exception as e:
+      if len( requests ) > 1:
+        # Each one is run on its own, so only the ones that fail get the error
+        return [ result for request in requests for result in self.__write( [ request ] ) ]
+      error = e
+    return [ ( [ ( 'error: %s\n' % error ).encode("utf-8") ], 1 ) ] * len( requests )
+
+  def __write_batch(self, requests):
+    """Run by the writer. Runs the changes (None is just a request for a new snapshot) and returns their results
+    and a new snapshot"""
+    changes = [ request for request in requests if request is not None ]
+    results = iter( self.__write( changes ) if changes else () )
+    return [ None if request is None else next( results ) for request in requests ], self.__take_snapshot()
+
+  async def __writer(self):
+    'Runs the queued changes, all the ones that are waiting at once'
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    while True:
+      jobs = [ await self.queue.get() ]
+      while len( jobs ) < self.MAX_BATCH and not self.queue.empty():
+        jobs.append( self.queue.get_nowait() )
+      try:
+        results, snapshot = await loop.run_in_executor( self.executor, self.__write_batch, [ r for r, f in jobs ] )
+      except asyncio.CancelledError:
+        raise
+      except BaseException as e:
+        if not isinstance( e, Exception ):
+          # Awaiting a SystemExit or a KeyboardInterrupt would stop the daemon
+          e = RuntimeError( 'The writer was stopped (%s)' % type( e ).__name__ )
+        for request, future in jobs:
+          if not future.done():
+            future.set_exception( e )
+        continue
+      self.__install( snapshot )
+      for ( request, future ), result in zip( jobs, results ):
+        if not future.done():
+          future.set_result( result )
+
+  async def __submit(self, request):
+    'Queues a change for the writer (or None for a new snapshot) and returns its result once the snapshot is updated'
+    import asyncio
+
+    future = asyncio.get_running_loop().create_future()
+    self.queue.put_nowait( ( request, future ) )
+    return await future
+
+  async def __check_version(self):
+    """Takes a new snapshot if someone else changed the inventory. The version is read in another thread, so the
+    readers are not blocked, at most once every VERSION_CHECK_INTERVAL seconds, and all the readers that arrive
+    while it is read wait for the same check"""
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    if self.version_check is None:
+      if self.version_checked is not None and loop.time() - self.version_checked < self.VERSION_CHECK_INTERVAL:
+        return
+      self.version_check = loop.create_task( self.__read_version() )
+    if await self.version_check != self.snapshot[0]:
+      await self.__submit( None )
+
+  async def __read_version(self):
+    'Reads the version of the inventory in a thread of the default executor (see __check_version)'
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    try:
+      return await loop.run_in_executor( None, self.versions.get_version )
+    finally:
+      self.version_check = None
+      self.version_checked = loop.time()
+
+  def __is_read(self, request):
+    'Returns True if the request only reads the inventory'
+    command = request.get( 'command' )
+    if command == 'console':
+      words = request['line'].split()
+      return not words or words[0] in self.READ_COMMANDS
+    return command in ( 'list', 'host' )
+
+  async def run(self, request, output):
+    'Runs a request writing its output to output. Returns the exit status'
+    command = request.get( 'command' )
+    if command not in ( 'list', 'host', 'console', 'batch' ):
+      output.write( 'Unknown request: %s\n' % command )
+      return 1
+    if command == 'console':
+      words = request['line'].split()
+      if words and words[0] in self.writer.BATCH_INVALID_COMMANDS:
+        output.write( 'Invalid command: %s\n' % request['line'] )
+        return 1
+    if is_interactive( request ):
+      output.write( 'The daemon cannot open an editor. Run the command without the daemon\n' )
+      return 1
+
+    if not self.__is_read( request ):
+      chunks, status = await self.__submit( request )
+      output.chunks.extend( chunks )
+      return status
+
+    await self.__check_version()
+    if command == 'list':
+      output.write( self.snapshot[1] )
+      output.write( b'\n' )
+    elif command == 'host':
+      output.write( self.snapshot[2].get_ansible_host_json( request['host'] ) + '\n' )
+    else:
+      self.output.set( output )
+      self.reader.onecmd( request['line'], skip_confirm=True )
+    return 0
+
+  async def __handle(self, reader, writer):
+    'Answers a client'
+    try:
+      line = await reader.readline()
+      if not line:
+        return
+      output = AnsibleInventory_DaemonOutput()
+      try:
+        status = await self.run( json.loads( line.decode("utf-8") ), output )
+      except Exception as e:
+        output.write( 'error: %s\n' % e )
+        status = 1
+      await output.send( writer, status )
+    except ( ConnectionError, ValueError ):
+      # The client went away or sent a request that is too long
+      pass
+    finally:
+      writer.close()
+
+  async def __serve(self):
+    import asyncio
+    import signal
+
+    loop = asyncio.get_running_loop()
+    self.queue = asyncio.Queue()
+    self.__install( await loop.run_in_executor( self.executor, self.__take_snapshot ) )
+
+    stop = asyncio.Event()
+    for signum in ( signal.SIGINT, signal.SIGTERM ):
+      loop.add_signal_handler( signum, stop.set )
+    server = await asyncio.start_unix_server( self.__handle, path=self.socket_path, limit=self.REQUEST_LIMIT )
+    writer = loop.create_task( self.__writer() )
+    try:
+      await stop.wait()
+    finally:
+      server.close()
+      writer.cancel()
+
+  def serve_forever(self):
+    'Listens on the socket until the daemon is stopped with SIGINT or SIGTERM'
+    import asyncio
+
+    if os.path.exists( self.socket_path ):
+      client = AnsibleInventory_DaemonClient.connect( self.socket_path )
+      if client:
+        client.sock.close()
+        raise RuntimeError( "There is already a daemon listening on %s" % self.socket_path )
+      # Left by a daemon that did not finish cleanly
+      os.unlink( self.socket_path )
+
+    stdout = sys.stdout
+    sys.stdout = AnsibleInventory_DaemonStdout( stdout, self.output )
+    try:
+      asyncio.run( self.__serve() )
+    finally:
+      sys.stdout = stdout
+      # A change that is being saved is finished
+      self.executor.shutdown()
+      if os.path.exists( self.socket_path ):
+        os.unlink( self.socket_path )
+
+
+class AnsibleInventory_DaemonClient:
+  'Sends requests to a running daemon'
+
+  def __init__(self, sock):
+    self.sock = sock
+
+  @classmethod
+  def connect(cls, socket_path):
+    'Returns a client connected to the daemon listening on socket_path, or None if there is none'
+    sock = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+    try:
+      sock.connect( socket_path )
+    except OSError:
+      sock.close()
+      return None
+    return cls( sock )
+
+  def request(self, request, stream):
+    'Sends a request (see Protocol) and writes the output to a binary stream. Returns the exit status'
+    with self.sock, self.sock.makefile( 'rb' ) as answer:
+      self.sock.sendall( json.dumps( request ).encode("utf-8") + b'\n' )
+      while True:
+        frame = answer.readline().split()
+        if not frame:
+          raise ConnectionError( "The daemon closed the connection" )
+        if frame[0] == b'exit':
+          return int( frame[1] )
+        remaining = int( frame[1] )
+        while remaining:
+          data = answer.read( min( remaining, 65536 ) )
+          if not data:
+            raise ConnectionError( "The daemon closed the connection" )
+          stream.write( data )
+          remaining -= len( data )
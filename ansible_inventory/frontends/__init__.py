@@ -25,6 +25,9 @@ class AI_Console_ValidationError(Exception):
 
 class AnsibleInventory_Console(cmd.Cmd):
 
+  # Commands that end the console, which are not valid in a batch
+  BATCH_INVALID_COMMANDS = ( 'EOF', 'exit' )
+
   def console_handler( f ):
     def wrapper(self, arg ):
       # parse args
@@ -58,8 +61,13 @@ class AnsibleInventory_Console(cmd.Cmd):
     signal.signal(signal.SIGINT, self.__signal_sigint)
 
     self.history_file = config.history_file
+    if not os.path.exists( self.history_file ):
+      open( self.history_file, 'a' ).close()
+    readline.read_history_file( self.history_file )
+    readline.set_completer_delims(' ')
 
     self.__skip_confirm = False
+    self.__cmd_failed = False
 
     self.color = AnsibleInventory_Color( config )
     self.C = self.color.color
@@ -284,6 +292,7 @@ class AnsibleInventory_Console(cmd.Cmd):
     print('')
 
   def __error(self, msg):
+    self.__cmd_failed = True
     if self.color.use_colors:
       print(self.color.BASE+"^   "+self.color.FAIL+'error '+self.color.BASE+msg+self.color.RESET)
     else:
@@ -400,7 +409,7 @@ class AnsibleInventory_Console(cmd.Cmd):
 
   def __print_list( self, e_list, start, newline ):
     try:
-      rows, columns = subprocess.check_output(['stty', 'size']).split()
+      rows, columns = subprocess.check_output(['stty', 'size'], stderr=subprocess.DEVNULL).split()
       rows = int(rows)
       columns = int(columns)
     except Exception:
@@ -475,9 +484,8 @@ class AnsibleInventory_Console(cmd.Cmd):
     #( in_groups
     in_groups = []
     if 'in_groups' in args_opt:
-      for g_regex in args_opt['in_groups'].split(','):
-        self.inventory.next_from_cache()
-        in_groups += self.inventory.list_groups( g_regex )
+      self.inventory.next_from_cache()
+      in_groups = self.inventory.list_groups( args_opt['in_groups'].split(',') )
 
       filtered_hosts = []
       for h in hosts:
@@ -755,12 +763,16 @@ class AnsibleInventory_Console(cmd.Cmd):
 
     if in_groups:
       if new_name:
-        for g_regex in in_groups:
-          self.inventory.rename_group_var(v_name, new_name, g_regex)
+        def rename_vars():
+          for g_regex in in_groups:
+            self.inventory.rename_group_var(v_name, new_name, g_regex)
+        self.inventory.run_transaction( rename_vars )
         self.__ok('Variable %s renamed to %s in selected groups' % (self.C(v_name), self.C(new_name)))
       if new_value:
-        for g_regex in in_groups:
-          self.inventory.change_group_var(v_name, new_value, g_regex)
+        def change_vars():
+          for g_regex in in_groups:
+            self.inventory.change_group_var(v_name, new_value, g_regex)
+        self.inventory.run_transaction( change_vars )
         self.__ok('Variable %s changed to %s in selected groups' % (self.C(v_name), self.C(new_value)))
 
     if 'in_hosts' in args_opt:
@@ -770,12 +782,16 @@ class AnsibleInventory_Console(cmd.Cmd):
 
     if in_hosts:
       if new_name:
-        for h_regex in in_hosts:
-          self.inventory.rename_host_var(v_name, new_name, h_regex)
+        def rename_vars():
+          for h_regex in in_hosts:
+            self.inventory.rename_host_var(v_name, new_name, h_regex)
+        self.inventory.run_transaction( rename_vars )
         self.__ok('Variable %s renamed to %s in selected hosts' % (self.C(v_name), self.C(new_name)))
       if new_value:
-        for h_regex in in_hosts:
-          self.inventory.change_host_var(v_name, new_value, h_regex)
+        def change_vars():
+          for h_regex in in_hosts:
+            self.inventory.change_host_var(v_name, new_value, h_regex)
+        self.inventory.run_transaction( change_vars )
         self.__ok('Variable %s changed to %s in selected hosts' % (self.C(v_name), self.C(new_value)))
 
   def __editor( self, dict_data ):
@@ -876,24 +892,26 @@ class AnsibleInventory_Console(cmd.Cmd):
       if not hosts:
         self.__warn('Host pattern %s does not match any host' % self.C(h_regex))
       elif self.__confirm('The following hosts will be permanently removed: %s.\n            Do you want to proceed?' % ', '.join( c_hosts ) ):
-        for h in hosts:
-          self.inventory.remove_host( h )
+        def remove_hosts():
+          for h in hosts:
+            self.inventory.remove_host( h )
+        self.inventory.run_transaction( remove_hosts )
         self.__ok('The hosts have been removed')
       else:
         return False
     else:
-      del_groups = []
-      for g_regex in from_groups:
-        gs = self.inventory.list_groups( g_regex )
-        del_groups += gs
+      del_groups = self.inventory.list_groups( from_groups )
 
       self.__info('The hosts matching %s would be removed from the following groups:' % self.C(h_regex))
       for g in del_groups:
         print( ' '+self.C(g), end='')
       print('\n')
       if self.__confirm('Do you want to proceed?'):
+        def remove_hosts():
+          for h in hosts:
+            self.inventory.remove_host( h_regex, from_groups=del_groups )
+        self.inventory.run_transaction( remove_hosts )
         for h in hosts:
-          self.inventory.remove_host( h_regex, from_groups=del_groups )
           self.__ok('Host %s removed from groups' % self.C(h))
 
   def __del_group( self, g_regex, from_groups ):
@@ -909,59 +927,62 @@ class AnsibleInventory_Console(cmd.Cmd):
       if not groups:
         self.__warn('Group pattern %s does not match any group' % self.C(g_regex))
       elif self.__confirm('The following groups will be permanently removed: %s.\n            Do you want to proceed?' % ', '.join( c_groups ) ):
-        some_error = False
-        for g in groups:
-          msg = self.inventory.remove_group( g )
-          if msg:
-            some_error = True
-            self.__warn( msg )
-        if not some_error:
+        def remove_groups():
+          errors = []
+          for g in groups:
+            try:
+              self.inventory.remove_group( g )
+            except AnsibleInventory_Exception as e:
+              errors.append( e )
+          return errors
+        errors = self.inventory.run_transaction( remove_groups )
+        for e in errors:
+          self.__warn( e.__str__() % tuple( self.C(x) for x in e.targets ) )
+        if not errors:
           self.__ok('The groups have been removed')
       else:
         return False
     else:
-      del_groups = []
-      for g_rex in from_groups:
-        gs = self.inventory.list_groups( g_rex )
-        del_groups += gs
+      del_groups = self.inventory.list_groups( from_groups )
 
       self.__info('The groups matching %s would be removed from the following groups:' % self.C(g_regex))
       for g in del_groups:
         print( ' '+self.C(g), end='')
       print('\n')
       if self.__confirm('Do you want to proceed?'):
+        def remove_groups():
+          for g in groups:
+            self.inventory.remove_group( g, from_groups=del_groups )
+        self.inventory.run_transaction( remove_groups )
         for g in groups:
-          self.inventory.remove_group( g, from_groups=del_groups )
           self.__ok('Group %s removed from groups' % self.C(g))
 
   def __del_var( self, var_name, from_groups, from_hosts ):
     'Handle "del var"'
 
     if from_groups:
-      del_groups = []
-      for g_regex in from_groups:
-        gs = self.inventory.list_groups( g_regex )
-        del_groups += gs
+      del_groups = self.inventory.list_groups( from_groups )
       self.__info('The variable %s would be removed from the following groups:' % self.C(var_name))
       for g in del_groups:
         print( ' '+self.C(g), end='')
       print('\n')
       if self.__confirm('Do you want to proceed?'):
-        for g in del_groups:
-          self.inventory.remove_group_var( var_name, g )
+        def remove_vars():
+          for g in del_groups:
+            self.inventory.remove_group_var( var_name, g )
+        self.inventory.run_transaction( remove_vars )
         self.__ok('Variable %s removed from groups' % self.C(var_name))
     elif from_hosts:
-      del_hosts = []
-      for h_regex in from_hosts:
-        hs = self.inventory.list_hosts( h_regex )
-        del_hosts += hs
+      del_hosts = self.inventory.list_hosts( from_hosts )
       self.__info('The variable %s would be removed from the following hosts:' % self.C(var_name))
       for h in del_hosts:
         print( ' '+self.C(h), end='')
       print('\n')
       if self.__confirm('Do you want to proceed?'):
-        for h in del_hosts:
-          self.inventory.remove_host_var( var_name, h )
+        def remove_vars():
+          for h in del_hosts:
+            self.inventory.remove_host_var( var_name, h )
+        self.inventory.run_transaction( remove_vars )
         self.__ok('Variable %s removed from hosts' % self.C(var_name))
 
   @console_handler
@@ -1177,3 +1198,45 @@ class AnsibleInventory_Console(cmd.Cmd):
   def onecmd(self, line, skip_confirm=False):
     self.__skip_confirm=skip_confirm
     return super(AnsibleInventory_Console, self).onecmd(line)
+
+  def batch(self, stream):
+    """Executes the commands read from stream, one per line, in a single inventory transaction so the inventory is
+    loaded and saved only once. Empty lines and lines starting with # are ignored. If someone else saves the
+    inventory in the meantime, the commands are run again over the new one. Returns the number of failed commands,
+    or the number of commands if the changes could not be saved."""
+    lines = [ ( n, line.strip() ) for n, line in enumerate( stream, 1 ) ]
+    lines = [ ( n, line ) for n, line in lines if line and not line.startswith('#') ]
+    runs = []
+    def run_lines():
+      if runs:
+        self.__warn('The inventory was changed by someone else. Running the commands again')
+      runs.append( None )
+      return self.__batch_lines( lines )
+    try:
+      return self.inventory.run_transaction( run_lines )
+    except Exception as e:
+      message = e.__str__()
+      if isinstance( e, AnsibleInventory_Exception ):
+        message = message % tuple( self.C(x) for x in e.targets )
+      self.__error( 'The changes could not be saved: ' + message )
+      return len( lines )
+
+  def __batch_lines(self, lines):
+    'Executes the ( number, command ) lines of a batch. Returns the number of failed commands'
+    failed = 0
+    for n, line in lines:
+      self.__cmd_failed = False
+      try:
+        if line.split()[0] in self.BATCH_INVALID_COMMANDS:
+          self.__error('Invalid command in batch mode')
+        else:
+          self.onecmd( self.precmd( line ), skip_confirm=True )
+      except Exception as e:
+        self.__error( e.__str__() )
+      if self.__cmd_failed:
+        failed += 1
+        print('[%d] error: %s' % (n, line))
+      else:
+        print('[%d] ok: %s' % (n, line))
+      print('')
+    return failed
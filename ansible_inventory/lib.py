@@ -1,11 +1,16 @@
 # -*- coding:utf-8 -*-
 # vim: set ts=2 sw=2 sts=2 et:
 
-import curses
+# Modules that are not needed to answer ansible (--list and --host) are imported where they are used
 import errno
 import fcntl
+import functools
+import json
 import os
+import re
+import stat
 import time
+from contextlib import contextmanager
 
 
 # Exceptions
@@ -27,47 +32,255 @@ class AnsibleInventory_InfoException( AnsibleInventory_Exception ):
   pass
 
 
+class AnsibleInventory_ConflictException( AnsibleInventory_Exception ):
+  'Raised by backends when the inventory was saved by someone else during a transaction'
+  pass
+
+
 # SimpleFlock from https://github.com/derpston/python-simpleflock
 class SimpleFlock:
-  """Provides the simplest possible interface to flock-based file locking. Intended for use with the `with` syntax. It will create/truncate/delete the lock file as necessary."""
+  """Provides the simplest possible interface to flock-based file locking. Intended for use with the `with` syntax.
+  It creates the lock file if necessary. Locks are exclusive unless shared=True, so several readers can hold
+  the lock at the same time while writers wait for all of them."""
 
-  def __init__(self, path, timeout = None):
+  class _Timeout( Exception ):
+    pass
+
+  def __init__(self, path, timeout = None, shared = False):
     self._path = path
     self._timeout = timeout
+    self._operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
     self._fd = None
 
   def __enter__(self):
-    self._fd = os.open(self._path, os.O_CREAT)
-    start_lock_search = time.time()
+    self._fd = os.open(self._path, os.O_CREAT | os.O_RDONLY, 0o666)
+    try:
+      if not self.__try_lock():
+        if self._timeout is None:
+          fcntl.flock(self._fd, self._operation)
+        elif self.__can_use_alarm():
+          self.__lock_with_alarm()
+        else:
+          self.__lock_with_backoff()
+    except BaseException as ex:
+      # Closing the descriptor also releases the lock in case it was acquired
+      os.close(self._fd)
+      self._fd = None
+      if isinstance(ex, self._Timeout):
+        raise self.__timeout_error()
+      raise
+    return self
+
+  def __try_lock(self):
+    "Tries to get the lock without blocking. Returns False if it is held by someone else"
+    try:
+      fcntl.flock(self._fd, self._operation | fcntl.LOCK_NB)
+      return True
+    except (OSError, IOError) as ex:
+      if ex.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+        raise
+      return False
+
+  def __timeout_error(self):
+    return BlockingIOError(errno.EAGAIN, 'Timeout waiting for lock %s' % self._path)
+
+  def __can_use_alarm(self):
+    "SIGALRM can only be used from the main thread and when no other timer is running"
+    import signal
+    import threading
+    return (threading.current_thread() is threading.main_thread() and
+            signal.getitimer(signal.ITIMER_REAL)[0] == 0 and
+            signal.getsignal(signal.SIGALRM) in (signal.SIG_DFL, signal.SIG_IGN))
+
+  def __lock_with_alarm(self):
+    "Blocks in flock, which is interrupted by SIGALRM when the timeout expires. Waiters are woken up as soon as the lock is released"
+    import signal
+    if self._timeout <= 0:
+      raise self.__timeout_error()
+
+    def on_alarm(signum, frame):
+      raise self._Timeout()
+
+    previous_handler = signal.signal(signal.SIGALRM, on_alarm)
+    try:
+      signal.setitimer(signal.ITIMER_REAL, self._timeout)
+      fcntl.flock(self._fd, self._operation)
+    finally:
+      signal.setitimer(signal.ITIMER_REAL, 0)
+      signal.signal(signal.SIGALRM, previous_handler)
+
+  def __lock_with_backoff(self):
+    "Polls the lock with exponential backoff and full jitter, so waiters do not wake up in lockstep"
+    import random
+    deadline = time.monotonic() + self._timeout
+    delay = 0.001
     while True:
-      try:
-        fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
-        # Lock acquired!
+      remaining = deadline - time.monotonic()
+      if remaining <= 0:
+        raise self.__timeout_error()
+      time.sleep(min(remaining, random.uniform(0, delay)))
+      if self.__try_lock():
         return
-      except (OSError, IOError) as ex:
-        if ex.errno != errno.EAGAIN:  # Resource temporarily unavailable
-          raise
-        elif self._timeout is not None and time.time() > (start_lock_search + self._timeout):
-          # Exceeded the user-specified timeout.
-          raise
-
-      # TODO It would be nice to avoid an arbitrary sleep here, but spinning
-      # without a delay is also undesirable.
-      time.sleep(0.1)
+      delay = min(delay * 2, 0.1)
 
   def __exit__(self, *args):
-    if self._fd:
+    if self._fd is not None:
       fcntl.flock(self._fd, fcntl.LOCK_UN)
       os.close(self._fd)
       self._fd = None
 
-    # Try to remove the lock file, but don't try too hard because it is
-    # unnecessary. This is mostly to help the user see whether a lock
-    # exists by examining the filesystem.
+    # The lock file is not removed: a waiter may already have it open, and it would
+    # end up holding a lock on a deleted file while a new process locks a new one.
+
+
+# Atomic file writes
+
+# The umask can only be read by changing it, which is not safe once there are other threads, so it is read once
+UMASK = os.umask( 0 )
+os.umask( UMASK )
+
+
+def file_permissions(path, default):
+  'Returns the permissions of a file, or default if it does not exist'
+  try:
+    return stat.S_IMODE( os.stat( path ).st_mode )
+  except FileNotFoundError:
+    return default
+
+
+@contextmanager
+def atomic_open(path, mode='w', permissions=None):
+  """Opens a temporary file in the same directory of path for writing. When the block ends without errors, the
+  file is flushed, fsynced and renamed to path, so readers always find either the old or the new contents. The file
+  gets the permissions of the one it replaces (or the default ones), unless permissions are given."""
+  import tempfile
+  path = os.path.abspath( path )
+  directory = os.path.dirname( path )
+  f_mode = permissions if permissions is not None else file_permissions( path, 0o666 & ~UMASK )
+
+  fd, tmp_path = tempfile.mkstemp( dir=directory, prefix='.%s.' % os.path.basename( path ), suffix='.tmp' )
+  try:
+    with os.fdopen( fd, mode ) as tmp_file:
+      yield tmp_file
+      tmp_file.flush()
+      os.fsync( tmp_file.fileno() )
+    os.chmod( tmp_path, f_mode )
+    os.replace( tmp_path, path )
+  except BaseException:
     try:
-      os.unlink(self._path)
-    except Exception:
+      os.unlink( tmp_path )
+    except OSError:
       pass
+    raise
+
+  # Make the rename itself durable
+  dir_fd = os.open( directory, os.O_RDONLY )
+  try:
+    os.fsync( dir_fd )
+  finally:
+    os.close( dir_fd )
+
+
+# Json encoding
+def iterencode_json(obj, chunk_size=65536, levels=3):
+  """Yields the json encoding of obj in chunks of about chunk_size characters, which joined are the same as
+  json.dumps( obj ), so big documents can be written without having all of them in memory. Dicts in the first
+  levels are encoded item by item and everything below them with json.dumps, which is much faster than the
+  pure python encoder used by JSONEncoder.iterencode."""
+  chunk = []
+  size = 0
+  for part in _iterencode_json_parts( obj, levels ):
+    chunk.append( part )
+    size += len( part )
+    if size >= chunk_size:
+      yield ''.join( chunk )
+      chunk = []
+      size = 0
+  if chunk:
+    yield ''.join( chunk )
+
+
+def _iterencode_json_parts(obj, levels):
+  'Yields the parts of the json encoding of obj. See iterencode_json'
+  if not levels or not isinstance( obj, dict ) or not obj:
+    yield json.dumps( obj )
+    return
+  separator = '{'
+  for key, value in obj.items():
+    if isinstance( key, str ):
+      yield separator + json.dumps( key ) + ': '
+    else:
+      # Keys that are not strings are converted as json.dumps does
+      yield separator + json.dumps( { key: None } )[ 1 : -len( 'null}' ) ]
+    yield from _iterencode_json_parts( value, levels - 1 )
+    separator = ', '
+  yield '}'
+
+
+# Selectors
+class AnsibleInventory_Selector:
+  """Matches names against a list of regular expressions (full match). Expressions without metacharacters
+  are resolved as literal names with set lookups and the rest are combined in a single compiled alternation,
+  so filtering a collection of names is a single pass. Use get_selector() to get cached instances."""
+
+  METACHARACTERS = frozenset('.^$*+?{}[]\\|()')
+
+  def __init__(self, regex_list):
+    self.regex_list = regex_list
+    self.match_all = '.*' in regex_list
+    self.literals = {}
+    patterns = []
+    for regex in dict.fromkeys( regex_list ):
+      if self.METACHARACTERS.isdisjoint( regex ):
+        self.literals[ regex ] = None
+      else:
+        patterns.append( regex )
+
+    # Expressions with capture groups may use backreferences, so they are not combined
+    self.__matchers = []
+    combinable = []
+    for regex in patterns:
+      compiled = re.compile( regex )
+      if compiled.groups:
+        self.__matchers.append( compiled.fullmatch )
+      else:
+        combinable.append( regex )
+    if combinable:
+      try:
+        self.__matchers.insert( 0, re.compile( '|'.join( '(?:%s)' % r for r in combinable ) ).fullmatch )
+      except re.error:
+        # i.e. inline global flags, which are only valid at the start of an expression
+        self.__matchers[0:0] = [ re.compile( r ).fullmatch for r in combinable ]
+
+  def is_literal(self):
+    'Returns True if the selector only contains literal names'
+    return not self.__matchers
+
+  def match(self, name):
+    'Returns True if name fully matches any of the expressions'
+    if self.match_all or name in self.literals:
+      return True
+    for matcher in self.__matchers:
+      if matcher( name ):
+        return True
+    return False
+
+  def filter(self, names):
+    'Returns a list with the matching names, keeping their order. "names" should be a dict or a set so literals are looked up in O(1)'
+    if self.match_all:
+      return list( names )
+    if self.is_literal():
+      return [ n for n in self.literals if n in names ]
+    return [ n for n in names if self.match( n ) ]
+
+
+@functools.lru_cache( maxsize=256 )
+def get_selector(*regex_list):
+  'Returns a (cached) AnsibleInventory_Selector for the regular expressions in regex_list'
+  try:
+    return AnsibleInventory_Selector( regex_list )
+  except re.error as e:
+    raise AnsibleInventory_Exception( 'Invalid regular expression %s: ' + e.msg.replace( '%', '%%' ), targets=( e.pattern, ) )
 
 
 # Colors
@@ -85,6 +298,7 @@ class AnsibleInventory_Color:
     self.colors = []
 
     if self.use_colors:
+      import curses
       curses.setupterm()
       if curses.tigetnum("colors") >= 256:
         self.colors = self.__generate_colors256()
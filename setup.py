@@ -44,7 +44,7 @@ DATA_FILES={}
 
 #-- PYPI VARS --
 PYPI_DOWNLOAD_URL='https://github.com/diego-treitos/ansible-inventory/archive/v'+VERSION+'.tar.gz'
-PYPI_DEPENDS=['redis', 'Pygments']
+PYPI_DEPENDS=['redis>=3.0', 'Pygments']
 PYPI_KEYWORDS=['ansible', 'inventory', 'dynamic', 'management']
 
 #-- DEB VARS --
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+# vim: set ts=2 sw=2 sts=2 et:
+
+# Compares the peak memory (RSS) of encoding a big inventory with json.dumps and with the chunked encoder used
+# by --list and the backends, writing it to a file. Each case runs in its own process.
+#
+# usage: test/benchmark_json_memory.py [hosts] [vars size]
+
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..' ) )
+from ansible_inventory.lib import iterencode_json
+
+
+def build_inventory(hosts, vars_size):
+  hostvars = {}
+  for n in range( hosts ):
+    hostvars[ 'host%d.example.com' % n ] = {
+      'ansible_host': '10.%d.%d.%d' % ( n >> 16 & 255, n >> 8 & 255, n & 255 ),
+      'description': 'x' * vars_size,
+      'tags': [ 'tag%d' % t for t in range( 10 ) ]
+    }
+  return {
+    'all': { 'hosts': list( hostvars ), 'children': [], 'vars': {} },
+    '_meta': { 'hostvars': hostvars }
+  }
+
+
+def max_rss():
+  'Peak RSS of this process in KiB'
+  return resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+
+
+def run_case(case, hosts, vars_size):
+  inventory = build_inventory( hosts, vars_size )
+  before = max_rss()
+  with tempfile.TemporaryFile( 'w' ) as out:
+    if case == 'dumps':
+      out.write( json.dumps( inventory ) )
+    else:
+      for chunk in iterencode_json( inventory ):
+        out.write( chunk )
+    size = out.tell()
+  print( json.dumps( { 'before': before, 'after': max_rss(), 'size': size } ) )
+
+
+if __name__ == '__main__':
+  if len( sys.argv ) > 1 and sys.argv[1] == '--case':
+    run_case( sys.argv[2], int( sys.argv[3] ), int( sys.argv[4] ) )
+    sys.exit( 0 )
+
+  hosts = int( sys.argv[1] ) if len( sys.argv ) > 1 else 50000
+  vars_size = int( sys.argv[2] ) if len( sys.argv ) > 2 else 500
+  print( 'Inventory with %d hosts and %d bytes of vars per host' % ( hosts, vars_size ) )
+  for case in ( 'dumps', 'stream' ):
+    output = subprocess.check_output( [ sys.executable, __file__, '--case', case, str( hosts ), str( vars_size ) ] )
+    result = json.loads( output.decode("utf-8") )
+    print( '  %-7s json: %6.1f MiB   peak RSS: %6.1f MiB   added by encoding: %6.1f MiB' % (
+      case, result['size'] / 1048576, result['after'] / 1024, ( result['after'] - result['before'] ) / 1024
+    ) )
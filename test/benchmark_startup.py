@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+# vim: set ts=2 sw=2 sts=2 et:
+
+# Measures how long ansible-inv takes to answer ansible (--list and --host) and checks that it does not import
+# the modules that are only needed by the console or to change the inventory. It exits with an error if any of them
+# is imported, or if budget is given and the median time of --list or --host is more than budget milliseconds over
+# the one of python alone.
+#
+# usage: test/benchmark_startup.py [runs] [budget]
+
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+TEST_DIR = os.path.dirname( os.path.abspath( __file__ ) )
+ANSIBLE_INV = os.path.join( TEST_DIR, '..', 'ansible-inv' )
+
+# Modules that must not be imported to answer ansible: the ones of the console and the ones only used to change
+# the inventory (once the ansible json is stored and the host vars index is built)
+CONSOLE_MODULES = ( 'argparse', 'cmd', 'curses', 'readline', 'yaml', 'ansible_inventory.frontends' )
+WRITE_MODULES = ( 'ast', 'getpass', 'hashlib', 'random', 'signal', 'tempfile', 'threading', 'uuid' )
+FORBIDDEN_MODULES = CONSOLE_MODULES + WRITE_MODULES
+
+
+def imported_modules(command):
+  'Returns the names of the modules imported by command, from the output of python -X importtime'
+  result = subprocess.run( [ sys.executable, '-X', 'importtime' ] + command, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.PIPE, check=True )
+  modules = set()
+  for line in result.stderr.decode("utf-8").splitlines():
+    if line.startswith( 'import time:' ) and '|' in line:
+      modules.add( line.rsplit( '|', 1 )[1].strip() )
+  return modules
+
+
+def run_times(command, runs):
+  'Returns the wall times in milliseconds of running command several times'
+  times = []
+  for _ in range( runs ):
+    start = time.perf_counter()
+    subprocess.run( command, stdout=subprocess.DEVNULL, check=True )
+    times.append( ( time.perf_counter() - start ) * 1000 )
+  return times
+
+
+if __name__ == '__main__':
+  runs = int( sys.argv[1] ) if len( sys.argv ) > 1 else 20
+  budget = float( sys.argv[2] ) if len( sys.argv ) > 2 else None
+
+  # ansible-inv uses the directory of a symlink to it as its home, so the test has its own configuration
+  home = tempfile.mkdtemp()
+  try:
+    link = os.path.join( home, 'ansible-inv' )
+    os.symlink( os.path.abspath( ANSIBLE_INV ), link )
+    os.mkdir( os.path.join( home, '.ansible' ) )
+    with open( os.path.join( home, '.ansible', 'ansible-inventory.cfg' ), 'w' ) as cfg:
+      cfg.write( "[global]\nuse_colors = False\nbackend = file\n\n[file_backend]\npath = inventory.json\n" )
+    subprocess.run( [ sys.executable, link, '--import', os.path.join( TEST_DIR, 'ansible_test_inventory.json' ) ],
+                    input=b'y\n', stdout=subprocess.DEVNULL, check=True )
+
+    host = 'host1.example.com'
+    commands = {
+      'python': [ sys.executable, '-c', 'pass' ],
+      '--list': [ sys.executable, link, '--list' ],
+      '--host': [ sys.executable, link, '--host', host ]
+    }
+
+    failed = False
+    for name in ( '--list', '--host' ):
+      # The first run stores the ansible json or builds the host vars index
+      run_times( commands[name], 1 )
+      unexpected = sorted( m for m in imported_modules( commands[name][1:] ) if m in FORBIDDEN_MODULES )
+      if unexpected:
+        failed = True
+        print( '%s imports modules only needed by the console or to change the inventory: %s' % ( name, ', '.join( unexpected ) ) )
+
+    print( 'Startup time (%d runs)' % runs )
+    medians = {}
+    for name, command in commands.items():
+      times = run_times( command, runs )
+      medians[name] = statistics.median( times )
+      print( '  %-7s median: %6.1f ms   min: %6.1f ms' % ( name, medians[name], min( times ) ) )
+    if budget is not None:
+      for name in ( '--list', '--host' ):
+        if medians[name] - medians['python'] > budget:
+          failed = True
+          print( '%s takes %.1f ms more than python, over the budget of %.1f ms' % ( name, medians[name] - medians['python'], budget ) )
+  finally:
+    shutil.rmtree( home )
+
+  sys.exit( 1 if failed else 0 )
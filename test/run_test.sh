@@ -11,8 +11,9 @@ prepare() {
     # Copy config file
     cp "test/ansible-inventory.cfg" "$ANSIBLE_HOME"
 
-    # Import test inventory
-    echo "y" | ./ansible-inv --import "test/ansible_test_inventory.json"
+    # Import test inventory, which leaves no files next to it
+    echo "y" | ./ansible-inv --import "test/ansible_test_inventory.json" || do_exit 1
+    ls -A test | grep -q '^\.' && do_exit 1
 }
 
 exec_cmd() {
@@ -36,7 +37,8 @@ run_test(){
 }
 
 do_exit(){
-    rm -f "/tmp/ansible_test_inventory.json"
+    [ -n "$DAEMON_PID" ] && kill "$DAEMON_PID" 2>/dev/null && wait "$DAEMON_PID"
+    rm -f "/tmp/ansible_test_inventory.json" /tmp/.ansible_test_inventory.json.*
     if [ "$1" == "0" ]; then
         kill -s USR1 $TOP_PID
     else
@@ -89,10 +91,103 @@ ai_tests=(
     'del group vp1.*|vp2.*'
 )
 
+ai_batch_tests=(
+    'add host btest1'
+    'add host name=btest2 host=1.2.3.4:2222'
+    'add group gbtest1'
+    'add host btest.* to_groups=gbtest1'
+    'add var k1=v1 to_groups=gbtest1'
+    'show hosts btest.* in_groups=gbtest1'
+    'del group gbtest1'
+    'del host btest.*'
+)
+
+run_batch_test(){
+    echo "------------------------------------------------"
+    echo "¬¬ ./ansible-inv --batch-file -"
+    printf '%s\n' "$@" | ./ansible-inv --batch-file - || do_exit 1
+    echo
+}
+
+# The lines that fail are reported, and the rest are saved
+ai_batch_error_tests=(
+    'add host bftest1'
+    'show hosts ['
+    'EOF'
+    'add host bftest2'
+)
+
+run_batch_error_test(){
+    echo "------------------------------------------------"
+    echo "¬¬ ./ansible-inv --batch-file - (with errors)"
+    output="$(printf '%s\n' "$@" | ./ansible-inv --batch-file -)"
+    retcode="$?"
+    echo "$output"
+    echo
+    [ "$retcode" == "1" ] || do_exit 1
+    [ "$(echo "$output" | grep -c '^\[[0-9]*\] error:')" == "2" ] || do_exit 1
+    ./ansible-inv --list | grep -q '"bftest2"' || do_exit 1
+    run_test 'del host bftest.*'
+}
+
+# Runs the daemon in the background, so the following commands are sent to it
+start_daemon(){
+    echo "------------------------------------------------"
+    echo "¬¬ ./ansible-inv --daemon"
+    ./ansible-inv --daemon &
+    DAEMON_PID=$!
+    for i in $(seq 50); do
+        [ -S "$ANSIBLE_HOME/ansible-inventory.sock" ] && break
+        sleep 0.1
+    done
+    [ -S "$ANSIBLE_HOME/ansible-inventory.sock" ] || do_exit 1
+    echo
+}
+
+check_daemon(){
+    echo "------------------------------------------------"
+    echo "¬¬ the daemon is still running"
+    # These would stop the daemon if it ran them
+    ./ansible-inv --batch 'EOF' && do_exit 1
+    ./ansible-inv --batch 'exit' && do_exit 1
+    kill -0 "$DAEMON_PID" 2>/dev/null || do_exit 1
+    ./ansible-inv --list | grep -q '"_meta"' || do_exit 1
+    [ "$(./ansible-inv --host db_slave1)" == "$DAEMON_HOST" ] || do_exit 1
+    echo "$DAEMON_HOST" | grep -q master_host || do_exit 1
+    # The daemon does not open editors: ansible-inv opens them itself and the daemon rejects them (the vars are
+    # written again, in another order)
+    EDITOR=true timeout 10 ./ansible-inv --batch 'edit vars in_host=db_slave1' || do_exit 1
+    timeout 10 python3 -c 'import sys
+from ansible_inventory.daemon import AnsibleInventory_DaemonClient
+client = AnsibleInventory_DaemonClient.connect( sys.argv[1] )
+sys.exit( client.request( { "command": "console", "line": sys.argv[2] }, sys.stdout.buffer ) )' \
+        "$ANSIBLE_HOME/ansible-inventory.sock" 'edit vars in_host=db_slave1'
+    [ "$?" == "1" ] || do_exit 1
+    echo
+}
+
+run_all_tests(){
+    for test in "${ai_tests[@]}"; do
+        run_test "$test"
+    done
+
+    run_batch_test "${ai_batch_tests[@]}"
+    run_batch_error_test "${ai_batch_error_tests[@]}"
+}
+
+echo "------------------------------------------------"
+echo "¬¬ test/test_inventory.py"
+python3 test/test_inventory.py || do_exit 1
+echo
+
 prepare
+run_all_tests
 
-for test in "${ai_tests[@]}"; do
-    run_test "$test"
-done
+# The same tests through the daemon
+prepare
+DAEMON_HOST="$(./ansible-inv --host db_slave1)"
+start_daemon
+run_all_tests
+check_daemon
 
 do_exit 0
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+# vim: set ts=2 sw=2 sts=2 et:
+
+# Tests of the inventory model (ansible_inventory.AnsibleInventory) over the file backend, with and without journal,
+# and over the sqlite backend.
+# They are run by test/run_test.sh.
+#
+# usage: test/test_inventory.py [-v]
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+TEST_DIR = os.path.dirname( os.path.abspath( __file__ ) )
+sys.path.insert( 0, os.path.join( TEST_DIR, '..' ) )
+from ansible_inventory import AnsibleInventory
+from ansible_inventory.backends import AnsibleInventory_FileBackend, AnsibleInventory_SqliteBackend
+
+
+class Config:
+  'The part of AI_Config used by the backends'
+  def __init__(self, config_home):
+    self.config_home = config_home
+
+
+class AnsibleInventoryTest( unittest.TestCase ):
+
+  journal = False
+
+  def setUp(self):
+    self.home = tempfile.mkdtemp()
+    with open( os.path.join( TEST_DIR, 'ansible_test_inventory.json' ) ) as f:
+      self.inventory_data = json.load( f )
+    self.inventory = self.open_inventory()
+    self.inventory.backend.save_inventory( self.inventory_data )
+
+  def tearDown(self):
+    shutil.rmtree( self.home )
+
+  def open_inventory(self):
+    'Returns a new inventory over the same files'
+    return AnsibleInventory( self.new_backend() )
+
+  def new_backend(self):
+    'Returns the backend of the inventories of the test'
+    parameters = { 'path': 'inventory.json', 'journal': str( self.journal ) }
+    return AnsibleInventory_FileBackend( parameters, Config( self.home ) )
+
+  def inventory_path(self):
+    'Returns the path of the inventory file'
+    return self.inventory.backend.json_path
+
+  def load_json(self, inventory=None):
+    'Returns the ansible inventory of a new inventory over the same files (or of inventory), decoded'
+    return json.loads( ( inventory or self.open_inventory() ).get_ansible_json() )
+
+  def test_reload_round_trip(self):
+    inventory = self.inventory
+    before = self.load_json( inventory )
+    inventory.add_host( 'rt1', 'rt1.example.com', 2222 )
+    inventory.add_hosts_to_groups( 'rt1', [ 'vp1_our1' ] )
+    inventory.remove_host( 'rt1' )
+    self.assertEqual( self.load_json(), before )
+
+    inventory.add_group( 'rt_group' )
+    inventory.add_var_to_groups( 'rt_var', "[1, {'a': None}]", 'rt_group' )
+    inventory.add_hosts_to_groups( 'db_slave1', [ 'rt_group' ] )
+    after = self.load_json( inventory )
+    self.assertEqual( self.load_json(), after )
+    self.assertEqual( after['rt_group'], { 'hosts': [ 'db_slave1' ], 'vars': { 'rt_var': [ 1, { 'a': None } ] }, 'children': [] } )
+
+    # A forced reload parses the same inventory again
+    inventory.reload( force=True )
+    self.assertEqual( self.load_json( inventory ), after )
+
+  def test_empty_inventory(self):
+    self.inventory.backend.save_inventory( {} )
+    inventory = self.open_inventory()
+    inventory.add_host( 'empty1' )
+    self.assertEqual( self.load_json()['all']['hosts'], [ 'empty1' ] )
+
+  def test_ansible_json_permissions(self):
+    inventory = self.inventory
+    for mode in ( 0o600, 0o640 ):
+      os.chmod( self.inventory_path(), mode )
+      inventory.add_host( 'perm%o' % mode )
+      inventory.get_ansible_json_bytes()
+      self.assertEqual( os.stat( inventory.backend.ansible_json_path ).st_mode & 0o777, mode )
+
+  def test_journal_permissions(self):
+    if not self.journal:
+      self.skipTest( 'No journal' )
+    inventory = self.inventory
+    os.chmod( self.inventory_path(), 0o600 )
+    inventory.add_host( 'journal1' )
+    self.assertEqual( os.stat( inventory.backend.journal_path ).st_mode & 0o777, 0o600 )
+    # Compacted
+    inventory.backend.journal_max_records = 1
+    inventory.add_host( 'journal2' )
+    self.assertEqual( os.stat( inventory.backend.journal_path + '.old' ).st_mode & 0o777, 0o600 )
+
+  def test_unknown_meta_keys(self):
+    self.inventory_data['_meta']['custom'] = { 'a': [ 1, 2 ] }
+    self.inventory.backend.save_inventory( self.inventory_data )
+    inventory = self.open_inventory()
+    inventory.add_host( 'meta1' )
+    inventory.add_var_to_hosts( 'v', '1', 'meta1' )
+    meta = self.load_json()['_meta']
+    self.assertEqual( meta['custom'], { 'a': [ 1, 2 ] } )
+    self.assertEqual( meta['hostvars']['meta1'], { 'v': 1 } )
+
+  def test_snapshot(self):
+    inventory = self.inventory
+    snapshot = inventory.snapshot()
+    ansible_json = snapshot.get_ansible_json()
+    host_vars = json.dumps( snapshot.get_host_vars( 'db_slave1' ) )
+    group_hosts = snapshot.get_group_hosts( 'vp1_our1' )
+
+    inventory.add_var_to_hosts( 'snap_var', '1', 'db_slave1' )
+    inventory.remove_host( 'db_slave1' )
+    inventory.add_host( 'snap1' )
+    inventory.add_hosts_to_groups( 'snap1', [ 'vp1_our1' ] )
+    inventory.rename_group( 'vp1_our1', 'snap_group' )
+
+    self.assertEqual( snapshot.get_ansible_json(), ansible_json )
+    self.assertEqual( json.dumps( snapshot.get_host_vars( 'db_slave1' ) ), host_vars )
+    self.assertEqual( snapshot.get_group_hosts( 'vp1_our1' ), group_hosts )
+    self.assertEqual( self.load_json(), self.load_json( inventory ) )
+
+    # A snapshot taken in a transaction has the changes that are not saved yet
+    with inventory.transaction():
+      inventory.add_host( 'snap2' )
+      snapshot = inventory.snapshot()
+      inventory.remove_host( 'snap2' )
+    self.assertIn( 'snap2', snapshot.list_hosts() )
+    self.assertNotIn( 'snap2', inventory.list_hosts() )
+
+  def change_everything(self, inventory):
+    'Changes the inventory through every public method that writes it, on data that was there before'
+    inventory.add_host( 'w1', 'w1.example.com', 2222 )
+    inventory.add_group( 'wg1' )
+    inventory.add_hosts_to_groups( 'w1|nginx1', [ 'wg1', 'dbs' ] )
+    inventory.add_group_to_groups( 'php', 'dbs|wg1' )
+    inventory.add_var_to_hosts( 'wv', "{'a': [1]}", 'w1|db_slave2' )
+    inventory.add_var_to_groups( 'wgv', '1', 'wg1|dbs' )
+    inventory.edit_host_vars( 'db_slave1', lambda h_vars: dict( h_vars, edited=True ) )
+    inventory.edit_group_vars( 'deploy1', lambda g_vars: dict( g_vars, edited=True ) )
+    inventory.rename_host_var( 'master_host', 'master', 'db_slave.*' )
+    inventory.change_host_var( 'ansible_host', "'10.0.0.1'", 'php1' )
+    inventory.rename_group_var( 'vpn', 'vpn2', 'deploy1' )
+    inventory.change_group_var( 'admin_user', "'root'", 'dbs' )
+    inventory.change_host( 'nginx2', '1.2.3.4', 22 )
+    inventory.rename_host( 'gluster1', 'gluster3' )
+    inventory.rename_group( 'web', 'web2' )
+    inventory.remove_host_var( 'ansible_host', 'php2' )
+    inventory.remove_group_var( 'http_proxy', 'deploy2' )
+    inventory.remove_host( 'nginx1', from_groups=[ 'nginx' ] )
+    inventory.remove_host( 'db_slave2' )
+    inventory.remove_group( 'gluster', from_groups=[ 'web2' ] )
+    inventory.remove_group( 'db_slave' )
+
+  def test_snapshot_writers(self):
+    inventory = self.inventory
+    snapshot = inventory.snapshot()
+    ansible_json = snapshot.get_ansible_json()
+    self.change_everything( inventory )
+    self.assertNotEqual( inventory.get_ansible_json(), ansible_json )
+    self.assertEqual( snapshot.get_ansible_json(), ansible_json )
+
+    # Every write in a single transaction, with the snapshot taken in it
+    inventory = self.open_inventory()
+    inventory.backend.save_inventory( self.inventory_data )
+    with inventory.transaction():
+      inventory.add_host( 'w0' )
+      snapshot = inventory.snapshot()
+      ansible_json = snapshot.get_ansible_json()
+      self.change_everything( inventory )
+    self.assertEqual( snapshot.get_ansible_json(), ansible_json )
+    self.assertEqual( self.load_json(), self.load_json( inventory ) )
+
+  def test_removed_group_hosts(self):
+    inventory = self.inventory
+    all_names = [ 'big%03d' % n for n in range( 100 ) ]
+    names = list( all_names )
+    with inventory.transaction():
+      inventory.add_group( 'big' )
+      for name in all_names:
+        inventory.add_host( name )
+      inventory.add_hosts_to_groups( 'big.*', [ 'big' ] )
+    snapshot = inventory.snapshot()
+
+    # Removing a few hosts leaves them in the hosts of the group (see AnsibleInventory_Group)
+    for name in names[10:20]:
+      inventory.remove_host( name, from_groups=[ 'big' ] )
+      names.remove( name )
+    self.assertEqual( inventory.get_group_hosts( 'big' ), names )
+
+    # Re-added hosts go to the end once
+    inventory.add_hosts_to_groups( 'big015', [ 'big' ] )
+    names.append( 'big015' )
+    self.assertEqual( inventory.get_group_hosts( 'big' ), names )
+    self.assertEqual( inventory.get_host_groups( 'big015' ), [ 'all', 'big' ] )
+
+    # Removing most of them compacts the group
+    for name in names[:60]:
+      inventory.remove_host( name )
+    del names[:60]
+    inventory.add_hosts_to_groups( 'big016', [ 'big' ] )
+    names.append( 'big016' )
+    self.assertEqual( inventory.get_group_hosts( 'big' ), names )
+    self.assertEqual( self.load_json()['big']['hosts'], names )
+
+    self.assertEqual( snapshot.get_group_hosts( 'big' ), all_names )
+
+
+class AnsibleInventoryJournalTest( AnsibleInventoryTest ):
+
+  journal = True
+
+
+class AnsibleInventorySqliteTest( AnsibleInventoryTest ):
+
+  def new_backend(self):
+    return AnsibleInventory_SqliteBackend( { 'path': 'inventory.db' }, Config( self.home ) )
+
+  def inventory_path(self):
+    return self.inventory.backend.db_path
+
+  def test_unknown_meta_keys(self):
+    self.skipTest( 'The sqlite backend only stores the hostvars of _meta' )
+
+
+if __name__ == '__main__':
+  unittest.main()